@@ -1,44 +1,275 @@
+import asyncio
+import atexit
+import base64
+import contextvars
+import functools
+import hashlib
+import hmac
+import json
 import os
 import pprint
 import random
 import re
 import secrets
 import string
-from datetime import datetime, timedelta
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, time, timedelta
 from email import policy
 from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
 from functools import wraps
+from time import sleep
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import bcrypt
-import boto3
+import click
 import markdown2 as markdown
+import numpy as np
 import requests
+import sqlalchemy as sa
 from bs4 import BeautifulSoup
-from flask import Flask, jsonify, request, send_from_directory
+from flask import (
+    Flask,
+    Response,
+    g,
+    has_request_context,
+    jsonify,
+    request,
+    send_from_directory,
+    stream_with_context,
+    url_for,
+)
 from flask_apscheduler import APScheduler
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from openai import OpenAI
-from pinecone import Pinecone
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-openai_client = OpenAI()
-ses_client = boto3.client("sesv2")
-pinecone_client = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+import profiling
+import resilience
+from blob_store import BlobStore
+from passwords import PasswordHasher, PoolBusy
+from rate_limit import MemoryBackend, RateLimit, SqlBackend
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from stages import INLINE, Pipeline, Stage, StageTimings
+from ttl_cache import TTLCache
+from work_queue import LEASED, PENDING, WorkQueue
 
-pc_index = pinecone_client.Index("ritual")
-memory_index = pinecone_client.Index("ritual-memory")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 app = Flask(__name__, static_folder="build", static_url_path="/")
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["RITUAL_DB_URL"]
 app.config["SCHEDULER_API_ENABLED"] = True
 
+# number of reverse proxies in front of the app, so `request.remote_addr`
+# is the client's address rather than the proxy's
+TRUSTED_PROXIES = int(os.environ.get("RITUAL_TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# profiles are written to RITUAL_PROFILE_DIR (see `profiling.py`): a request
+# is profiled when it sends RITUAL_PROFILE_SECRET in `X-Ritual-Profile`, and a
+# scheduled job or cli command on every run when it's named in
+# RITUAL_PROFILE_JOBS. with neither set nothing is hooked in at all
+PROFILE_DIR = os.environ.get("RITUAL_PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+PROFILE_SECRET = os.environ.get("RITUAL_PROFILE_SECRET")
+PROFILE_JOBS = set(filter(None, os.environ.get("RITUAL_PROFILE_JOBS", "").split(",")))
+# "sample" or "cprofile"
+PROFILE_MODE = os.environ.get("RITUAL_PROFILE_MODE", "sample")
+PROFILE_HEADER = "X-Ritual-Profile"
+
+if PROFILE_SECRET:
+
+    @app.before_request
+    def start_request_profile():
+        given = request.headers.get(PROFILE_HEADER)
+        if given is not None and hmac.compare_digest(
+            given.encode("utf-8"), PROFILE_SECRET.encode("utf-8")
+        ):
+            g.profile = profiling.start(
+                f"{request.method}-{request.endpoint}", PROFILE_DIR, PROFILE_MODE
+            )
+
+    @app.teardown_request
+    def stop_request_profile(_):
+        context = g.pop("profile", None)
+        if context is not None:
+            profiling.stop(context)
+
+
+# profiles every run of `func` when `name` is in RITUAL_PROFILE_JOBS,
+# otherwise returns `func` untouched
+def profiled(name):
+    def decorator(func):
+        if name not in PROFILE_JOBS:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiling.profile(name, PROFILE_DIR, PROFILE_MODE):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# nothing here touches credentials or the network
+# `create_app` wires up the database and (optionally) starts the scheduler
 scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler.start()
 
 CORS(app)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy()
+
+
+# retries are done by `guarded` so the SDKs' own retry loops are turned off
+def _openai_client():
+    from openai import OpenAI
+
+    return OpenAI(timeout=OPENAI_POLICY.timeout, max_retries=0)
+
+
+def _ses_client():
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "sesv2",
+        config=Config(
+            connect_timeout=SES_POLICY.timeout,
+            read_timeout=SES_POLICY.timeout,
+            retries={"max_attempts": 1},
+        ),
+    )
+
+
+def _pinecone_client():
+    from pinecone import Pinecone
+
+    return Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+
+
+# external clients are built on first use and then shared by every request
+# in the process, so imports stay cheap and a worker only pays for what it uses
+CLIENT_FACTORIES = {
+    "openai": _openai_client,
+    "ses": _ses_client,
+    "pinecone": _pinecone_client,
+    "pc_index": lambda: get_client("pinecone").Index("ritual"),
+    "memory_index": lambda: get_client("pinecone").Index("ritual-memory"),
+}
+
+_clients = {}
+_clients_lock = threading.RLock()
+
+
+def get_client(name):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = CLIENT_FACTORIES[name]()
+
+        return _clients[name]
+
+
+# overrides a client, e.g. with the fakes in `bench/`
+def register_client(name, client):
+    with _clients_lock:
+        _clients[name] = client
+
+
+# per-call timeouts and retry budgets for each external service
+OPENAI_POLICY = RetryPolicy(attempts=3, timeout=60.0)
+EMBEDDING_POLICY = RetryPolicy(attempts=3, timeout=15.0)
+PINECONE_POLICY = RetryPolicy(attempts=3, timeout=5.0)
+SES_POLICY = RetryPolicy(attempts=2, timeout=10.0)
+EXA_POLICY = RetryPolicy(attempts=2, timeout=10.0)
+
+# once Exa reports the quota is gone, skip it for this long
+EXA_QUOTA_COOLDOWN = 3600
+
+# total time one user's newsletter may spend across all calls and retries
+NEWSLETTER_DEADLINE_SECONDS = 180
+# same, for newsletters generated while a client waits on the request
+REQUEST_DEADLINE_SECONDS = 90
+
+BREAKERS = {
+    name: CircuitBreaker(name) for name in ("openai", "pinecone", "ses", "exa")
+}
+
+# connection-level failures raised by the SDKs, matched by class name so the
+# SDKs don't have to be imported to check for them
+TRANSIENT_ERRORS = {
+    "APIConnectionError",  # openai, includes timeouts
+    "TransportError",  # httpx
+    "HTTPClientError",  # botocore connection/read timeouts
+    "EndpointConnectionError",  # botocore
+    "MaxRetryError",  # urllib3, used by pinecone
+    "ProtocolError",  # urllib3
+    "PineconeProtocolError",
+}
+
+
+def is_transient_error(e):
+    if isinstance(e, (TimeoutError, ConnectionError, requests.RequestException)):
+        return True
+
+    # openai/httpx/exa use `status_code`, pinecone uses `status`
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+
+    # botocore's ClientError keeps it in the response dict
+    response = getattr(e, "response", None)
+    if status is None and isinstance(response, dict):
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+
+    return any(cls.__name__ in TRANSIENT_ERRORS for cls in type(e).__mro__)
+
+
+# calls `func(timeout)` with the service's timeout, retry and breaker
+def guarded(service, policy, func):
+    return resilience.call(BREAKERS[service], policy, is_transient_error, func)
+
+
+async def guarded_async(service, policy, func):
+    return await resilience.call_async(
+        BREAKERS[service], policy, is_transient_error, func
+    )
+
+
+# files under the project root, read once per process
+@functools.cache
+def load_template(path):
+    with open(os.path.join(BASE_DIR, path), "r") as f:
+        return f.read()
+
+
+def create_app(start_scheduler=None):
+    if "sqlalchemy" not in app.extensions:
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["RITUAL_DB_URL"]
+        db.init_app(app)
+        scheduler.init_app(app)
+
+        load_template(SUMMARY_PROMPT_PATH)
+        load_template(ONBOARDING_TEMPLATE_PATH)
+
+    if start_scheduler is None:
+        start_scheduler = os.environ.get("RITUAL_SCHEDULER_ENABLED", "1") == "1"
+
+    if start_scheduler and not scheduler.running:
+        scheduler.start()
+
+    return app
+
 
 TEMPERATURE = 0.99
 DATE_FORMAT = "%Y-%m-%d"
@@ -46,14 +277,28 @@ TIME_FORMAT = "%H:%M:%S"
 DATETIME_FORMAT = f"{DATE_FORMAT} {TIME_FORMAT}"
 
 GPT_MODEL = "gpt-4o"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# per-user weekly token allowance across all LLM calls, 0 disables enforcement
+# users past their budget get the cheaper newsletter path (no Exa, smaller input)
+LLM_WEEKLY_TOKEN_BUDGET = int(os.environ.get("RITUAL_WEEKLY_TOKEN_BUDGET", 0))
+LLM_USAGE_FLUSH_SECONDS = 60
+
+# max characters of entries + webpages packed into a newsletter prompt
+NEWSLETTER_PACKING_BUDGET = 7000
+REDUCED_PACKING_BUDGET = 3000
+
+
+SUMMARY_PROMPT_PATH = "prompts/summary.txt"
+ONBOARDING_TEMPLATE_PATH = "onboarding.html"
 
 
 class EthosDefault:
     core = "A friendly, helpful partner focused on the routines, rituals, and personal growth of the user."
 
-
-with open("prompts/summary.txt", "r") as f:
-    EthosDefault.summary = f.read()
+    @staticmethod
+    def summary():
+        return load_template(SUMMARY_PROMPT_PATH)
 
 
 class Emotions:
@@ -82,16 +327,28 @@ class Emotions:
     FRUSTRATION = "Here's an example of the user feeling frustration."
     CONTENTMENT = "Here's an example of the user feeling contentment."
 
+    # (name, prompt) pairs in declaration order
     @classmethod
-    def list_emotions(cls):
+    def items(cls):
         return [
-            value
+            (name.lower(), value)
             for name, value in cls.__dict__.items()
-            if not name.startswith("__")
-            and name != "list_emotions"
-            and not callable(value)
+            if name.isupper()
         ]
 
+    @classmethod
+    def list_names(cls):
+        return [name for name, _ in cls.items()]
+
+    @classmethod
+    def list_emotions(cls):
+        return [value for _, value in cls.items()]
+
+
+# Sunday newsletters go out at this local time unless the user picks another
+DEFAULT_TIMEZONE = "America/Chicago"
+DEFAULT_DELIVERY_TIME = time(9, 0)
+
 
 class User(db.Model):
     user_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -105,15 +362,54 @@ class User(db.Model):
     cli_secret = db.Column(db.String(256))
     web_secret = db.Column(db.String(256))
     last_newsletter = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # IANA zone name, e.g. "Europe/Berlin"
+    timezone = db.Column(db.String(64), default=DEFAULT_TIMEZONE, nullable=False)
+    delivery_time = db.Column(db.Time, default=DEFAULT_DELIVERY_TIME, nullable=False)
 
 
 class Email(db.Model):
     email_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.user_id"))
-    raw_email = db.Column(db.Text, nullable=False)
+    # zlib-compressed MIME message with attachments swapped out for blob store
+    # references, only loaded when `raw_email` is actually read
+    raw_email_compressed = db.deferred(
+        db.Column(db.LargeBinary(length=2**24 - 1), nullable=False)
+    )
+    # the entry text pulled out of the message, which is what nearly every reader needs
+    text = db.Column(db.Text(length=2**24 - 1))
     creation_date = db.Column(db.DateTime, default=datetime.now)
     imported_data = db.Column(db.Boolean, default=False)
 
+    # deleted along with the email, wherever the email is deleted from
+    embedding = db.relationship(
+        "EmailEmbedding", uselist=False, cascade="all, delete-orphan"
+    )
+    # written with the email, deleted by `delete_emails`
+    blobs = db.relationship("EmailBlob", passive_deletes="all")
+
+    # serves both the date range queries and keyset paging through history
+    __table_args__ = (
+        db.Index("ix_email_user_created", "user_id", "creation_date", "email_id"),
+    )
+
+    def __init__(self, raw_email=None, **kwargs):
+        super().__init__(**kwargs)
+        if raw_email is not None:
+            self.raw_email = raw_email
+
+    # the stored message, attachments are still blob references
+    # see `restore_attachments` for the original, as the zip export has it
+    @property
+    def raw_email(self):
+        return zlib.decompress(self.raw_email_compressed).decode("utf-8")
+
+    @raw_email.setter
+    def raw_email(self, raw):
+        self.raw_email_compressed, self.text, digests = pack_raw_email(
+            raw, self.imported_data
+        )
+        self.blobs = [EmailBlob(digest=digest) for digest in sorted(digests)]
+
 
 class Ethos(db.Model):
     ethos_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -130,6 +426,146 @@ class Token(db.Model):
     creation_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
 
 
+# an attachment of the email kept in the blob store, a blob is deleted once no
+# email references it
+class EmailBlob(db.Model):
+    email_id = db.Column(
+        db.Integer,
+        db.ForeignKey("email.email_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    digest = db.Column(db.String(64), primary_key=True, index=True)
+
+
+# a blob whose last reference was deleted, removed by `clean_blobs` unless it's
+# referenced again by then
+class OrphanBlob(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)
+    released_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# the entry's embedding, kept locally so per-user analysis doesn't need pinecone
+# stored as raw float32 bytes
+class EmailEmbedding(db.Model):
+    email_id = db.Column(
+        db.Integer,
+        db.ForeignKey("email.email_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    vector = db.Column(db.LargeBinary, nullable=False)
+
+
+# every newsletter a user has been sent, as rendered html
+class Newsletter(db.Model):
+    newsletter_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.user_id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    creation_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    subject = db.Column(db.String(256))
+    html = db.Column(db.Text(length=2**24 - 1), nullable=False)
+    color = db.Column(db.String(16))
+    # utc, set on newsletters generated ahead of their delivery
+    scheduled_for = db.Column(db.DateTime, index=True)
+    # null until the newsletter has gone out
+    sent_at = db.Column(db.DateTime)
+
+
+# a /web-newsletter generation, run in the background and polled for by the web app
+class NewsletterRequest(db.Model):
+    request_id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.user_id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    creation_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    # pending -> running -> done | failed
+    status = db.Column(db.String(16), default="pending", nullable=False, index=True)
+    started_at = db.Column(db.DateTime)
+    # the request's entries as [date, text] pairs
+    entries = db.Column(db.JSON, nullable=False)
+    newsletter_id = db.Column(
+        db.Integer, db.ForeignKey("newsletter.newsletter_id", ondelete="SET NULL")
+    )
+    html_tree = db.Column(db.JSON)
+
+
+# running per-week emotion similarity sums, `scores` maps emotion -> sum
+# mean for the week is scores[emotion] / entries
+class EmotionWeek(db.Model):
+    emotion_week_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.user_id", ondelete="CASCADE"), nullable=False
+    )
+    week = db.Column(db.Date, nullable=False)
+    entries = db.Column(db.Integer, default=0, nullable=False)
+    scores = db.Column(db.JSON, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "week", name="uc_emotion_week"),
+    )
+
+
+# shared token buckets for `SqlBackend`, keys are hashed identifiers
+class RateLimitBucket(db.Model):
+    bucket_key = db.Column(db.String(128), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False, index=True)
+
+
+# one user's newsletter in a batch, worked off by `drain_newsletter_queue`
+# (see `work_queue.py` for the lifecycle)
+class NewsletterTask(db.Model):
+    task_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    route = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.user_id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    creation_date = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    status = db.Column(db.String(16), default="pending", nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    available_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    leased_until = db.Column(db.DateTime)
+    claim = db.Column(db.String(32), index=True)
+    last_error = db.Column(db.Text)
+    # utc send time of a newsletter generated ahead of its delivery, a user
+    # can't have the same send time queued twice
+    scheduled_for = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_newsletter_task_claimable", "status", "available_at"),
+        db.Index(
+            "ix_newsletter_task_send", "route", "user_id", "scheduled_for", unique=True
+        ),
+    )
+
+
+# weekly token aggregates, one row per (user, route, model, week)
+# user_id 0 is used for calls made outside of any user's context
+class LlmUsage(db.Model):
+    usage_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    route = db.Column(db.String(64), nullable=False)
+    model = db.Column(db.String(64), nullable=False)
+    week = db.Column(db.Date, nullable=False)
+    requests = db.Column(db.Integer, default=0, nullable=False)
+    prompt_tokens = db.Column(db.Integer, default=0, nullable=False)
+    completion_tokens = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "route", "model", "week", name="uc_llm_usage"),
+    )
+
+
 # for actions performed through email
 # POST requests _only_
 # `username` must be included in the JSON body of the request
@@ -189,21 +625,11 @@ def token_auth(func):
     return wrapper
 
 
-# only allows requests within certain time window (Sunday, 7:45 - 8:15 CST)
-# times here are in GMT
+# only allows requests within a window before the user's delivery time
+# (by default Sunday, 8:15 - 8:45 in their timezone)
 def cli_auth(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        now = datetime.now()
-        if (
-            (now.hour == 12 and now.minute < 45)
-            or (now.hour == 13 and now.minute > 15)
-            or now.hour < 12
-            or now.hour > 13
-            or now.weekday() != 6
-        ):
-            return "Unauthorized", 401
-
         auth = request.headers.get("Authorization")
         if auth is None:
             return "Unauthorized", 401
@@ -215,7 +641,7 @@ def cli_auth(func):
 
             user = User.query.filter(User.cli_secret == secret).first()
 
-            if user is not None:
+            if user is not None and in_cli_window(user, utc_now()):
                 request.user_id = user.user_id
                 return func(*args, **kwargs)
             else:
@@ -224,6 +650,136 @@ def cli_auth(func):
     return wrapper
 
 
+# "memory" (per process), "db" (shared by every worker) or "off"
+RATE_LIMIT_BACKEND = os.environ.get("RITUAL_RATE_LIMIT_BACKEND", "memory")
+
+CONFIG_TOKEN_IP_LIMIT = RateLimit("config_token_ip", 10, 3600)
+CONFIG_TOKEN_ACCOUNT_LIMIT = RateLimit("config_token_account", 3, 3600)
+SIGNUP_IP_LIMIT = RateLimit("signup_ip", 5, 3600)
+SIGNUP_ACCOUNT_LIMIT = RateLimit("signup_account", 3, 86400)
+REGISTER_IP_LIMIT = RateLimit("register_ip", 5, 3600)
+REGISTER_ACCOUNT_LIMIT = RateLimit("register_account", 5, 3600)
+LOGIN_IP_LIMIT = RateLimit("login_ip", 30, 300)
+LOGIN_ACCOUNT_LIMIT = RateLimit("login_account", 10, 900)
+IMPORT_LIMIT = RateLimit("import", 10, 3600)
+EXPORT_LIMIT = RateLimit("export", 5, 3600)
+
+
+@functools.cache
+def rate_limit_backend():
+    if RATE_LIMIT_BACKEND == "db":
+        return SqlBackend(lambda: db.engine, RateLimitBucket.__table__)
+
+    return MemoryBackend()
+
+
+def client_ip():
+    return request.remote_addr
+
+
+def json_field(name):
+    return lambda: (request.get_json(silent=True) or {}).get(name)
+
+
+def query_arg(name):
+    return lambda: request.args.get(name)
+
+
+def authenticated_user():
+    return request.user_id
+
+
+# rejects the request with a 429 once `identify()`'s bucket under `limit` is
+# empty, requests that `identify` returns None for aren't counted
+# goes below `token_auth` to limit per authenticated user
+def rate_limited(limit, identify):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            identifier = identify()
+            if RATE_LIMIT_BACKEND == "off" or identifier is None:
+                return func(*args, **kwargs)
+
+            try:
+                wait = rate_limit_backend().take(limit, identifier)
+            except Exception as e:
+                # a broken limiter shouldn't take the endpoint down with it
+                print(f"rate limit '{limit.name}' unavailable, allowing request: {e}")
+                wait = 0
+
+            if wait > 0:
+                print(f"rate limit '{limit.name}' reached")
+                return "Too Many Requests", 429, {"Retry-After": str(int(wait) + 1)}
+
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+NEWSLETTER_WEEKDAY = 6
+# a send time missed by less than this is still delivered, late
+DELIVERY_GRACE = timedelta(hours=12)
+# 7:45-8:15 local for the default 9AM delivery
+CLI_WINDOW_OPENS = timedelta(minutes=75)
+CLI_WINDOW_CLOSES = timedelta(minutes=45)
+
+UTC = ZoneInfo("UTC")
+
+
+# naive like every other datetime in the database, the server runs on utc
+def utc_now():
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def user_zone(user):
+    try:
+        return ZoneInfo(user.timezone or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+# this week's delivery for `user` in naive utc: the coming Sunday at their local
+# delivery time, or the last one if it was missed by less than `DELIVERY_GRACE`
+def scheduled_send_time(user, now):
+    zone = user_zone(user)
+    local_now = now.replace(tzinfo=UTC).astimezone(zone)
+    days_ahead = (NEWSLETTER_WEEKDAY - local_now.weekday()) % 7
+
+    local_send = datetime.combine(
+        local_now.date() + timedelta(days=days_ahead),
+        user.delivery_time or DEFAULT_DELIVERY_TIME,
+        tzinfo=zone,
+    )
+    send = local_send.astimezone(UTC).replace(tzinfo=None)
+    if send < now - DELIVERY_GRACE:
+        # wall clock arithmetic, so daylight saving changes keep the local time
+        local_send += timedelta(days=7)
+        send = local_send.astimezone(UTC).replace(tzinfo=None)
+
+    return send
+
+
+def in_cli_window(user, now):
+    send = scheduled_send_time(user, now)
+
+    return send - CLI_WINDOW_OPENS <= now <= send - CLI_WINDOW_CLOSES
+
+
+# bounds all external calls made while handling the request, retries included
+def with_deadline(seconds):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with resilience.deadline(seconds):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def set_user_active(user_id):
     user = User.query.filter_by(user_id=user_id).first()
     print(f"updating the activity of user '{user.username}'")
@@ -233,23 +789,138 @@ def set_user_active(user_id):
     return user
 
 
-def openai_prompt(system_prompt, user_prompt):
-    print("prompting gpt...")
-    oai_response = openai_client.chat.completions.create(
-        model=GPT_MODEL,
-        temperature=TEMPERATURE,
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt,
-            },
-            {"role": "user", "content": user_prompt},
-        ],
+# (user_id, route) that LLM usage is attributed to
+# scheduled jobs set this explicitly, requests fall back to `request.user_id`
+_usage_scope = ContextVar("usage_scope", default=None)
+
+# usage waiting to be written by `flush_llm_usage`
+# keyed by (user_id, route, model, week) -> [requests, prompt_tokens, completion_tokens]
+_pending_usage = {}
+_pending_usage_lock = threading.Lock()
+
+
+@contextmanager
+def usage_scope(user_id, route):
+    reset_token = _usage_scope.set((user_id, route))
+    try:
+        yield
+    finally:
+        _usage_scope.reset(reset_token)
+
+
+def current_usage_scope():
+    scope = _usage_scope.get()
+    if scope is not None:
+        return scope
+
+    if has_request_context():
+        return getattr(request, "user_id", 0), request.endpoint or "unknown"
+
+    return 0, "unknown"
+
+
+# monday of the week containing `date`
+def week_start(date):
+    return (date - timedelta(days=date.weekday())).date()
+
+
+# buffers usage in memory, the scheduler persists it off the request path
+def record_usage(model, prompt_tokens, completion_tokens=0):
+    user_id, route = current_usage_scope()
+    key = (user_id, route, model, week_start(datetime.now()))
+
+    with _pending_usage_lock:
+        totals = _pending_usage.setdefault(key, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += prompt_tokens
+        totals[2] += completion_tokens
+
+
+def upsert_usage(rows):
+    if db.engine.dialect.name == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    table = LlmUsage.__table__
+    for (user_id, route, model, week), (count, prompt, completion) in rows.items():
+        statement = insert(table).values(
+            user_id=user_id,
+            route=route,
+            model=model,
+            week=week,
+            requests=count,
+            prompt_tokens=prompt,
+            completion_tokens=completion,
+        )
+
+        increments = {
+            "requests": table.c.requests + count,
+            "prompt_tokens": table.c.prompt_tokens + prompt,
+            "completion_tokens": table.c.completion_tokens + completion,
+        }
+
+        if db.engine.dialect.name == "mysql":
+            statement = statement.on_duplicate_key_update(**increments)
+        else:
+            statement = statement.on_conflict_do_update(
+                index_elements=["user_id", "route", "model", "week"], set_=increments
+            )
+
+        db.session.execute(statement)
+
+
+# tokens used by `user_id` this week, including anything not yet flushed
+def weekly_tokens_used(user_id):
+    week = week_start(datetime.now())
+    stored = (
+        db.session.query(
+            db.func.coalesce(
+                db.func.sum(LlmUsage.prompt_tokens + LlmUsage.completion_tokens), 0
+            )
+        )
+        .filter(LlmUsage.user_id == user_id, LlmUsage.week == week)
+        .scalar()
     )
 
-    print(f"prompt finished. usage: {oai_response.usage}")
+    with _pending_usage_lock:
+        pending = sum(
+            totals[1] + totals[2]
+            for key, totals in _pending_usage.items()
+            if key[0] == user_id and key[3] == week
+        )
 
-    return oai_response.choices[0].message.content
+    return int(stored) + pending
+
+
+def user_over_budget(user_id):
+    if LLM_WEEKLY_TOKEN_BUDGET <= 0:
+        return False
+
+    over = weekly_tokens_used(user_id) >= LLM_WEEKLY_TOKEN_BUDGET
+    if over:
+        print(f"user id {user_id} is over their weekly token budget")
+
+    return over
+
+
+def chat_messages(system_prompt, user_prompt):
+    return [
+        {
+            "role": "system",
+            "content": system_prompt,
+        },
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def record_completion_usage(oai_response):
+    print(f"prompt finished. usage: {oai_response.usage}")
+    record_usage(
+        GPT_MODEL,
+        oai_response.usage.prompt_tokens,
+        oai_response.usage.completion_tokens,
+    )
 
 
 def style_email_html(html, recipient, format=True):
@@ -286,23 +957,29 @@ def get_text_from_email(email_content):
     return html_content
 
 
-# shorthand for the `ses_client.send_email` function
+# shorthand for the SES `send_email` function
 def send_email(subject, html_content, recipient, format=True):
     print(f"sending email '{subject}' to {recipient}")
     print(
-        ses_client.send_email(
-            FromEmailAddress="ritual@joeytan.dev",
-            Destination={"ToAddresses": [recipient]},
-            Content={
-                "Simple": {
-                    "Subject": {"Data": subject},
-                    "Body": {
-                        "Html": {
-                            "Data": (style_email_html(html_content, recipient, format))
-                        }
-                    },
-                }
-            },
+        guarded(
+            "ses",
+            SES_POLICY,
+            lambda timeout: get_client("ses").send_email(
+                FromEmailAddress="ritual@joeytan.dev",
+                Destination={"ToAddresses": [recipient]},
+                Content={
+                    "Simple": {
+                        "Subject": {"Data": subject},
+                        "Body": {
+                            "Html": {
+                                "Data": (
+                                    style_email_html(html_content, recipient, format)
+                                )
+                            }
+                        },
+                    }
+                },
+            ),
         )
     )
 
@@ -332,149 +1009,516 @@ def get_user_entries_in_range(user_id, days):
 
 
 def get_db_email_text(email_object):
-    msg = BytesParser(policy=policy.default).parsebytes(
-        email_object.raw_email.encode("utf-8")
-    )
-    return get_text_from_email(msg)
+    if email_object.text is not None:
+        return email_object.text
 
+    if email_object.imported_data:
+        return email_object.raw_email
 
-# formatted in a string for GPT
-def format_emails_for_gpt(emails):
-    formatted_string = ""
-    for e in emails:
-        formatted_string += f"{e.creation_date} -- "
-        if e.imported_data:
-            formatted_string += e.raw_email
-        else:
-            formatted_string += get_db_email_text(e)
+    return get_text_from_email(parse_raw_email(email_object.raw_email))
 
-        formatted_string += "\n\n"
 
-    return formatted_string if len(formatted_string) > 0 else "No emails logged."
+def parse_raw_email(raw):
+    return BytesParser(policy=policy.default).parsebytes(raw.encode("utf-8"))
 
 
-def get_embedding(text):
-    return (
-        openai_client.embeddings.create(input=text, model="text-embedding-3-small")
-        .data[0]
-        .embedding
-    )
+BLOB_STORE_PATH = os.environ.get("RITUAL_BLOB_PATH", os.path.join(BASE_DIR, "blobs"))
+RAW_EMAIL_COMPRESSION_LEVEL = 6
+# marks a MIME part whose payload lives in the blob store
+BLOB_HEADER = "X-Ritual-Blob"
 
 
-# get oai embedding for `text`
-# then find most similar quote
-def get_quote(text):
-    embedding = get_embedding(text)
+@functools.cache
+def blob_store():
+    return BlobStore(BLOB_STORE_PATH)
 
-    responses = [
-        x["metadata"]
-        for x in pc_index.query(
-            vector=embedding,
-            top_k=5,
-            include_metadata=True,
-            filter={"author": {"$ne": "Frank Herbert"}},
-        )["matches"]
-    ]
 
-    return random.choice(responses)
+# attachments and inline images, anything that isn't part of the entry's text
+def is_attachment_part(part):
+    if part.is_multipart():
+        return False
 
+    return (
+        part.get_content_disposition() == "attachment"
+        or part.get_content_maintype() != "text"
+    )
 
-# @app.route("/analyze-emails", methods=["POST"])
-def analyze_emails():
-    emails = get_user_entries_in_range(1, 30)
-    ids = [e.email_id for e in emails]
 
-    counts = {}
-    for emotion in Emotions.list_emotions():
-        print(f"analyzing for {emotion}")
-        emotion_embedding = get_embedding(emotion)
+# moves attachment payloads into the blob store and leaves a reference header
+# in their place, returns (message, digests of the blobs it references); the
+# message is unchanged if it has neither attachments nor reference headers
+def strip_attachments(raw):
+    message = parse_raw_email(raw)
 
-        closest = [
-            (r["score"], r["metadata"]["email_id"])
-            for r in memory_index.query(
-                vector=emotion_embedding,
-                top_k=1,
-                include_metadata=True,
-                filter={"email_id": {"$in": ids}},
-            )["matches"][:1]
-        ][0]
+    # only ever set here, one arriving with the message would be restored from
+    # whatever path it names
+    stripped = False
+    for part in message.walk():
+        if part[BLOB_HEADER] is not None:
+            del part[BLOB_HEADER]
+            stripped = True
 
-        counts[emotion] = closest
+    if not message.is_multipart():
+        return (message.as_string() if stripped else raw), set()
 
-    total = 0
-    for emotion, email_id in counts.items():
-        # email = Email.query.filter_by(email_id=email_id[1]).first()
-        print(f"{emotion}, {email_id[0]}: {email_id[1]}")
-        print("------------")
+    digests = set()
+    for part in message.walk():
+        if not is_attachment_part(part):
+            continue
 
-        total += email_id[0]
+        digest = blob_store().put(part.get_payload(decode=True) or b"")
+        digests.add(digest)
 
-    print(f"average score: {total / len(counts)}")
+        del part["Content-Transfer-Encoding"]
+        part[BLOB_HEADER] = digest
+        part.set_payload("")
+        stripped = True
 
+    return (message.as_string() if stripped else raw), digests
 
-def get_color(formatted_email_text):
-    openai_response = openai_prompt(
-        "Assign a hex color code representing the mood of the user's input. Ensure these colors are subtle and off-colored, gently guiding the user's subconscious to the desired tone and mood. Respond _only_ with the hex code.",
-        formatted_email_text,
-    )
 
-    hex_code = "#FFFFFF"
+# the original message, with attachment payloads read back from the blob store
+# parts whose blob is gone (e.g. a node without the blob directory) keep
+# their reference
+def restore_attachments(raw):
+    message = parse_raw_email(raw)
+    if not message.is_multipart():
+        return raw
 
-    hex_regex = r"#[0-9a-fA-F]{6}"
-    if re.match(hex_regex, openai_response):
-        hex_code = re.search(hex_regex, openai_response).group(0)
-    else:
-        print('color response not valid, defaulting to "#FFFFFF"')
-        print('response: "' + openai_response + '"')
+    restored = False
+    for part in message.walk():
+        if part[BLOB_HEADER] is None:
+            continue
 
-    hex_code = hex_code[1:]
-    # subtracting from 255 to treat it as origin
-    rgb = tuple(int(hex_code[i : i + 2], 16) for i in (0, 2, 4))
+        # long enough that the header may have been folded
+        digest = str(part[BLOB_HEADER]).strip()
+        if not blob_store().exists(digest):
+            print(f"error: attachment blob {digest} is missing")
+            continue
 
-    radius = 80
+        del part[BLOB_HEADER]
+        part["Content-Transfer-Encoding"] = "base64"
+        part.set_payload(base64.encodebytes(blob_store().get(digest)).decode("ascii"))
+        restored = True
 
-    # normalize to within radius
-    magnitude = sum((255 - rgb[i]) ** 2 for i in range(3)) ** 0.5
+    return message.as_string() if restored else raw
 
-    if magnitude > radius:
-        rgb = tuple(255 - int((255 - rgb[i]) * radius / magnitude) for i in range(3))
 
-    hex_code = "#" + "".join(f"{x:02x}" for x in rgb)
+# (compressed message, extracted text, attachment digests) as stored on an
+# `Email`; imported entries are plain text rather than MIME
+def pack_raw_email(raw, imported_data=False):
+    if imported_data:
+        stored, text, digests = raw, raw, set()
+    else:
+        stored, digests = strip_attachments(raw)
+        text = get_text_from_email(parse_raw_email(stored))
 
-    return hex_code
+    compressed = zlib.compress(stored.encode("utf-8"), RAW_EMAIL_COMPRESSION_LEVEL)
 
+    return compressed, text, digests
 
-def create_user(email):
-    user = User.query.filter_by(username=email).first()
-    if user is not None:
-        return "This user is already registered", 409
 
-    user = User(username=email, password=secrets.token_hex(32))
-    db.session.add(user)
-    db.session.commit()
+# how long a blob stays after its last reference is gone; another email may be
+# storing the same payload, and its reference isn't committed yet
+BLOB_GRACE = timedelta(minutes=10)
 
-    print(f"user created for {email}")
 
-    with open("onboarding.html", "r") as f:
-        print(f"sending onboarding email to {email}")
-        ses_client.send_email(
-            FromEmailAddress="ritual@joeytan.dev",
-            Destination={"ToAddresses": [email]},
-            Content={
-                "Simple": {
-                    "Subject": {"Data": "Welcome to Ritual!"},
-                    "Body": {"Html": {"Data": f.read()}},
-                }
-            },
-            ReplyToAddresses=["ritual@joeytan.dev"],
+# deletes `emails` and their blob references, in the caller's transaction. the
+# blobs they referenced are left to `clean_blobs`, so a rolled back deletion
+# never loses one
+def delete_emails(emails):
+    now = datetime.now()
+    ids = [email.email_id for email in emails]
+    for i in range(0, len(ids), 1000):
+        chunk = ids[i : i + 1000]
+        digests = {
+            digest
+            for (digest,) in db.session.query(EmailBlob.digest).filter(
+                EmailBlob.email_id.in_(chunk)
+            )
+        }
+        EmailBlob.query.filter(EmailBlob.email_id.in_(chunk)).delete(
+            synchronize_session=False
         )
 
-    return user
+        for digest in digests:
+            db.session.merge(OrphanBlob(digest=digest, released_at=now))
 
+    for email in emails:
+        db.session.delete(email)
 
-@app.route("/newsletter-signup", methods=["POST"])
-def newsletter_signup():
-    email = request.json["email"]
+
+# (date, text) pairs formatted in a string for GPT
+def format_entries(entries):
+    formatted_string = ""
+    for date, text in entries:
+        formatted_string += f"{date} -- {text}\n\n"
+
+    return formatted_string if len(formatted_string) > 0 else "No emails logged."
+
+
+# one request for all of `texts`, vectors come back in the same order
+def get_embeddings(texts):
+    response = guarded(
+        "openai",
+        EMBEDDING_POLICY,
+        lambda timeout: get_client("openai").embeddings.create(
+            input=texts, model=EMBEDDING_MODEL, timeout=timeout
+        ),
+    )
+    record_usage(EMBEDDING_MODEL, response.usage.prompt_tokens)
+
+    return [x.embedding for x in sorted(response.data, key=lambda x: x.index)]
+
+
+# the model accepts 8191 tokens, but a week of entries in one vector recalls
+# poorly, so long texts are embedded as several focused chunks instead
+EMBEDDING_CHUNK_TOKENS = 512
+EMBEDDING_MAX_CHUNKS = 16
+EMBEDDING_BATCH_INPUTS = 256
+# conservative, the app doesn't ship a tokenizer
+CHARS_PER_TOKEN = 3
+# reciprocal rank fusion constant
+RRF_K = 60
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+# splits on paragraphs, then sentences, and packs the pieces into chunks of at
+# most `max_tokens`; past `max_chunks`, evenly spaced chunks are kept so the
+# whole span of the text is still represented
+def chunk_text(text, max_tokens=EMBEDDING_CHUNK_TOKENS, max_chunks=EMBEDDING_MAX_CHUNKS):
+    limit = max_tokens * CHARS_PER_TOKEN
+
+    pieces = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= limit:
+            pieces.append(paragraph)
+            continue
+
+        for sentence in SENTENCE_END.split(paragraph):
+            while len(sentence) > limit:
+                pieces.append(sentence[:limit])
+                sentence = sentence[limit:]
+            pieces.append(sentence)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if len(piece) == 0:
+            continue
+
+        if len(current) > 0 and len(current) + 2 + len(piece) > limit:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+
+    if len(current) > 0:
+        chunks.append(current)
+
+    if len(chunks) == 0:
+        # the api rejects empty input
+        return [" "]
+
+    if len(chunks) > max_chunks:
+        step = len(chunks) / max_chunks
+        chunks = [chunks[int(i * step)] for i in range(max_chunks)]
+
+    return chunks
+
+
+# chunk vectors for each of `texts`, every chunk of every text embedded in as
+# few requests as possible
+def embed_chunks(texts):
+    chunked = [chunk_text(t) for t in texts]
+    flat = [c for chunks in chunked for c in chunks]
+
+    vectors = []
+    for i in range(0, len(flat), EMBEDDING_BATCH_INPUTS):
+        vectors += get_embeddings(flat[i : i + EMBEDDING_BATCH_INPUTS])
+
+    return regroup(vectors, chunked)
+
+
+# splits the flat `vectors` back into one list per text of `chunked`
+def regroup(vectors, chunked):
+    grouped = []
+    start = 0
+    for chunks in chunked:
+        grouped.append(vectors[start : start + len(chunks)])
+        start += len(chunks)
+
+    return grouped
+
+
+# one vector standing for the whole text, for per-entry analysis
+def mean_vector(vectors):
+    return normalize_rows(np.asarray(vectors, dtype=np.float32)).mean(axis=0)
+
+
+# merges ranked match lists from several query vectors, deduplicated by `key`,
+# best fused rank first
+def fuse_matches(responses, top_k, key=lambda match: match["id"]):
+    scores = {}
+    matches = {}
+    for response in responses:
+        for rank, match in enumerate(response["matches"]):
+            k = key(match)
+            scores[k] = scores.get(k, 0.0) + 1.0 / (RRF_K + rank + 1)
+            matches.setdefault(k, match)
+
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+    return [matches[k] for k in best]
+
+
+def query_index(index_name, vector, top_k, filter):
+    return guarded(
+        "pinecone",
+        PINECONE_POLICY,
+        lambda timeout: get_client(index_name).query(
+            vector=vector,
+            top_k=top_k,
+            include_metadata=True,
+            filter=filter,
+            _request_timeout=timeout,
+        ),
+    )
+
+
+QUOTE_FILTER = {"author": {"$ne": "Frank Herbert"}}
+
+
+def pick_quote(query_response):
+    return random.choice([x["metadata"] for x in query_response["matches"]])
+
+
+QUOTE_TOP_K = 5
+
+
+# pinecone filter for a user's past entries, minus the ones already in the prompt
+def memory_filter(user_id, exclude_email_ids):
+    return {
+        "user_id": {"$eq": user_id},
+        "email_id": {"$nin": exclude_email_ids},
+    }
+
+
+MOOD_TREND_DEFAULT_WEEKS = 12
+MOOD_TREND_MAX_WEEKS = 104
+EMOTION_BACKFILL_BATCH = 256
+
+
+# unit-length rows, so a matrix product gives cosine similarities
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return matrix / norms
+
+
+# (emotions x dims) matrix of the `Emotions` prompts, embedded once per process
+@functools.cache
+def emotion_matrix():
+    with usage_scope(0, "emotion_matrix"):
+        vectors = get_embeddings(Emotions.list_emotions())
+
+    return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+def vector_to_bytes(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def vectors_from_bytes(blobs):
+    return np.vstack([np.frombuffer(b, dtype=np.float32) for b in blobs])
+
+
+# (entries x emotions) cosine similarities in a single matrix multiply
+def emotion_scores(vectors):
+    return normalize_rows(np.asarray(vectors, dtype=np.float32)) @ emotion_matrix().T
+
+
+# stores the entries' embeddings and folds their emotion scores into the
+# user's weekly sums, so the trend never has to be recomputed from scratch
+# `emails` and `vectors` are parallel lists
+def record_emotions(user_id, emails, vectors):
+    if len(emails) == 0:
+        return
+
+    for email, vector in zip(emails, vectors):
+        db.session.merge(
+            EmailEmbedding(
+                email_id=email.email_id, user_id=user_id, vector=vector_to_bytes(vector)
+            )
+        )
+
+    add_emotion_scores(
+        user_id, [week_start(e.creation_date) for e in emails], emotion_scores(vectors)
+    )
+
+
+def add_emotion_scores(user_id, weeks, scores):
+    names = Emotions.list_names()
+
+    by_week = {}
+    for week, row in zip(weeks, scores):
+        by_week.setdefault(week, []).append(row)
+
+    for week, rows in by_week.items():
+        totals = np.sum(rows, axis=0)
+
+        emotion_week = (
+            EmotionWeek.query.filter_by(user_id=user_id, week=week)
+            .with_for_update()
+            .first()
+        )
+        if emotion_week is None:
+            emotion_week = EmotionWeek(
+                user_id=user_id, week=week, entries=0, scores={n: 0.0 for n in names}
+            )
+            db.session.add(emotion_week)
+
+        # reassigned rather than mutated so the JSON column is flagged dirty
+        emotion_week.scores = {
+            name: emotion_week.scores.get(name, 0.0) + float(total)
+            for name, total in zip(names, totals)
+        }
+        emotion_week.entries += len(rows)
+
+
+# the user's full (entries x emotions) similarity matrix over stored embeddings
+# returns the entries' creation dates in row order alongside it
+def user_emotion_matrix(user_id, days=None):
+    query = (
+        db.session.query(Email.creation_date, EmailEmbedding.vector)
+        .join(Email, Email.email_id == EmailEmbedding.email_id)
+        .filter(EmailEmbedding.user_id == user_id)
+    )
+    if days is not None:
+        query = query.filter(
+            Email.creation_date > datetime.now() - timedelta(days=days)
+        )
+
+    rows = query.all()
+    if len(rows) == 0:
+        return [], np.zeros((0, len(Emotions.list_names())), dtype=np.float32)
+
+    return [r[0] for r in rows], emotion_scores(vectors_from_bytes([r[1] for r in rows]))
+
+
+# recomputes the user's weekly sums from their stored embeddings in one matrix
+# multiply, e.g. after the `Emotions` prompts change. weeks whose entries have
+# since been deleted have nothing to rebuild from and keep their sums
+def rebuild_emotion_weeks(user_id):
+    dates, scores = user_emotion_matrix(user_id)
+    weeks = [week_start(d) for d in dates]
+
+    EmotionWeek.query.filter(
+        EmotionWeek.user_id == user_id, EmotionWeek.week.in_(set(weeks))
+    ).delete()
+    add_emotion_scores(user_id, weeks, scores)
+
+    return len(set(weeks))
+
+
+def mood_trend(user_id, weeks):
+    since = week_start(datetime.now()) - timedelta(weeks=weeks - 1)
+    rows = (
+        EmotionWeek.query.filter(
+            EmotionWeek.user_id == user_id, EmotionWeek.week >= since
+        )
+        .order_by(EmotionWeek.week)
+        .all()
+    )
+
+    trend = []
+    for row in rows:
+        means = {
+            name: row.scores.get(name, 0.0) / row.entries if row.entries else 0.0
+            for name in Emotions.list_names()
+        }
+        trend.append(
+            {
+                "week": row.week.strftime(DATE_FORMAT),
+                "entries": row.entries,
+                "scores": means,
+                "dominant": max(means, key=means.get),
+            }
+        )
+
+    return trend
+
+
+COLOR_PROMPT = "Assign a hex color code representing the mood of the user's input. Ensure these colors are subtle and off-colored, gently guiding the user's subconscious to the desired tone and mood. Respond _only_ with the hex code."
+
+
+def normalize_color(openai_response):
+    hex_code = "#FFFFFF"
+
+    hex_regex = r"#[0-9a-fA-F]{6}"
+    if re.match(hex_regex, openai_response):
+        hex_code = re.search(hex_regex, openai_response).group(0)
+    else:
+        print('color response not valid, defaulting to "#FFFFFF"')
+        print('response: "' + openai_response + '"')
+
+    hex_code = hex_code[1:]
+    # subtracting from 255 to treat it as origin
+    rgb = tuple(int(hex_code[i : i + 2], 16) for i in (0, 2, 4))
+
+    radius = 80
+
+    # normalize to within radius
+    magnitude = sum((255 - rgb[i]) ** 2 for i in range(3)) ** 0.5
+
+    if magnitude > radius:
+        rgb = tuple(255 - int((255 - rgb[i]) * radius / magnitude) for i in range(3))
+
+    hex_code = "#" + "".join(f"{x:02x}" for x in rgb)
+
+    return hex_code
+
+
+def create_user(email):
+    user = User.query.filter_by(username=email).first()
+    if user is not None:
+        return "This user is already registered", 409
+
+    user = User(username=email, password=secrets.token_hex(32))
+    db.session.add(user)
+    db.session.commit()
+
+    print(f"user created for {email}")
+
+    print(f"sending onboarding email to {email}")
+    guarded(
+        "ses",
+        SES_POLICY,
+        lambda timeout: get_client("ses").send_email(
+            FromEmailAddress="ritual@joeytan.dev",
+            Destination={"ToAddresses": [email]},
+            Content={
+                "Simple": {
+                    "Subject": {"Data": "Welcome to Ritual!"},
+                    "Body": {"Html": {"Data": load_template(ONBOARDING_TEMPLATE_PATH)}},
+                }
+            },
+            ReplyToAddresses=["ritual@joeytan.dev"],
+        ),
+    )
+
+    return user
+
+
+@app.route("/newsletter-signup", methods=["POST"])
+@rate_limited(SIGNUP_IP_LIMIT, client_ip)
+@rate_limited(SIGNUP_ACCOUNT_LIMIT, json_field("email"))
+def newsletter_signup():
+    email = request.json["email"]
 
     print(f"newsletter_signup called for email '{email}'")
     try:
@@ -485,6 +1529,46 @@ def newsletter_signup():
         return str(e), 400
 
 
+# one memory per chunk of the entry, recall dedupes them by email id
+# ids are picked up front so a retried upsert overwrites instead of duplicating
+def memory_vectors(email, vectors):
+    return [
+        {
+            "id": "".join(
+                secrets.choice(string.ascii_letters + string.digits) for _ in range(32)
+            ),
+            "values": vector,
+            "metadata": {
+                "user_id": email.user_id,
+                "email_id": email.email_id,
+                "chunk": i,
+            },
+        }
+        for i, vector in enumerate(vectors)
+    ]
+
+
+MEMORY_UPSERT_BATCH = 100
+
+
+# returns pinecone's response for each batch
+def upsert_memories(vectors):
+    responses = []
+    for i in range(0, len(vectors), MEMORY_UPSERT_BATCH):
+        batch = vectors[i : i + MEMORY_UPSERT_BATCH]
+        responses.append(
+            guarded(
+                "pinecone",
+                PINECONE_POLICY,
+                lambda timeout: get_client("memory_index").upsert(
+                    batch, _request_timeout=timeout
+                ),
+            )
+        )
+
+    return responses
+
+
 @app.route("/email-log-activities", methods=["POST"])
 @email_auth
 def email_log_activities():
@@ -526,24 +1610,12 @@ def email_log_activities():
                 deliverer,
             )
 
-        embedding = get_embedding(request.json["email_data"])
-        print(
-            memory_index.upsert(
-                [
-                    {
-                        "id": "".join(
-                            secrets.choice(string.ascii_letters + string.digits)
-                            for _ in range(32)
-                        ),
-                        "values": embedding,
-                        "metadata": {
-                            "user_id": request.user_id,
-                            "email_id": email.email_id,
-                        },
-                    }
-                ]
-            )
-        )
+        vectors = embed_chunks([get_db_email_text(email)])[0]
+
+        print(upsert_memories(memory_vectors(email, vectors)))
+
+        record_emotions(request.user_id, [email], [mean_vector(vectors)])
+        db.session.commit()
 
         return "success", 200
     except Exception as e:
@@ -556,38 +1628,196 @@ def email_log_activities():
         return str(e), 400
 
 
-def get_newsletter(formatted_email_text):
-    # can we do this without prompting gpt twice?
-    oai_response = openai_prompt(EthosDefault.summary, formatted_email_text)
+IMPORT_BATCH_SIZE = 100
+
+
+class ImportLineError(Exception):
+    pass
+
+
+# creation dates are stored naive in server local time, like `datetime.now()`
+def local_import_date(date):
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+
+    return date
+
+
+# one entry per line, shaped like the web client's entries:
+#   {"createdDate": "2023-05-01", "content": "..."}
+# yields (creation date, raw entry, imported_data) or an `ImportLineError`
+def iter_ndjson_entries(lines):
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        try:
+            entry = json.loads(line)
+            content = entry["content"]
+            if not isinstance(content, str) or len(content.strip()) == 0:
+                raise ValueError("empty content")
+
+            created = local_import_date(datetime.fromisoformat(entry["createdDate"]))
+            yield created, content, True
+        except (ValueError, KeyError, TypeError) as e:
+            yield ImportLineError(f"line {number}: {e}")
+
 
+# messages from an mbox export, e.g. the entries previously sent to ritual
+# `lines` are bytes, only one message is held in memory at a time
+def iter_mbox_entries(lines):
+    message = []
+
+    def entry():
+        raw = b"".join(message).decode("utf-8", errors="replace")
+        parsed = parse_raw_email(raw)
+        try:
+            created = local_import_date(parsedate_to_datetime(parsed["Date"]))
+        except (TypeError, ValueError):
+            return ImportLineError(f"message without a usable date: {parsed['Subject']}")
+
+        return created, raw, False
+
+    for line in lines:
+        if line.startswith(b"From "):
+            if message:
+                yield entry()
+            message = []
+            continue
+
+        # mboxrd escaping
+        if line.startswith(b">") and line.lstrip(b">").startswith(b"From "):
+            line = line[1:]
+
+        message.append(line)
+
+    if message:
+        yield entry()
+
+
+# inserts, embeds and upserts entries a batch at a time, without receipts
+# yields running progress after every batch
+def import_entries(user_id, entries):
+    progress = {"imported": 0, "skipped": 0, "errors": []}
+
+    def flush(batch):
+        emails = [
+            Email(
+                user_id=user_id,
+                raw_email=raw,
+                creation_date=created,
+                imported_data=imported_data,
+            )
+            for created, raw, imported_data in batch
+        ]
+        db.session.add_all(emails)
+        db.session.flush()
+
+        chunk_vectors = embed_chunks([get_db_email_text(e) for e in emails])
+        upsert_memories(
+            [m for e, v in zip(emails, chunk_vectors) for m in memory_vectors(e, v)]
+        )
+        record_emotions(user_id, emails, [mean_vector(v) for v in chunk_vectors])
+
+        db.session.commit()
+        # nothing from this batch is needed again
+        db.session.expunge_all()
+
+        progress["imported"] += len(emails)
+
+    batch = []
+    with usage_scope(user_id, "import_entries"):
+        for entry in entries:
+            if isinstance(entry, ImportLineError):
+                progress["skipped"] += 1
+                if len(progress["errors"]) < 20:
+                    progress["errors"].append(str(entry))
+                continue
+
+            batch.append(entry)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(batch)
+                batch = []
+                yield progress
+
+        if batch:
+            flush(batch)
+
+    yield progress
+
+
+def import_format(content_type):
+    return "mbox" if "mbox" in (content_type or "") else "ndjson"
+
+
+# streams the upload in and progress out, one JSON object per batch:
+#   curl -H "Authorization: Bearer ..." -H "Content-Type: application/x-ndjson" \
+#       --data-binary @entries.ndjson /import-entries
+@app.route("/import-entries", methods=["POST"])
+@token_auth
+@rate_limited(IMPORT_LIMIT, authenticated_user)
+def import_entries_route():
+    user_id = request.user_id
+    print(f"importing entries for user id {user_id}")
+
+    def generate():
+        if import_format(request.content_type) == "mbox":
+            entries = iter_mbox_entries(request.stream)
+        else:
+            entries = iter_ndjson_entries(
+                line.decode("utf-8", errors="replace") for line in request.stream
+            )
+
+        progress = {}
+        try:
+            for progress in import_entries(user_id, entries):
+                yield json.dumps({"imported": progress["imported"]}) + "\n"
+        except Exception as e:
+            db.session.rollback()
+            print(f"error importing entries for user id {user_id}: {e}")
+
+            yield json.dumps(
+                {"error": str(e), "imported": progress.get("imported", 0)}
+            ) + "\n"
+            return
+
+        yield json.dumps({"done": True, **progress}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+QUOTE_MAX_LEN = 500
+
+
+def render_newsletter(oai_response, quote_data):
     html = markdown.markdown(oai_response)
     for tag in ("<h1>", "<h2>", "<h3>", "<h4>"):
         html = html.replace(tag, tag[:-1] + ' style="font-family: Helvetica;">')
 
-    max_len = 500
-    quote_data = get_quote(formatted_email_text)
-    color = get_color(quote_data["text"][:max_len])
+    max_len = QUOTE_MAX_LEN
+    quote_text = quote_data["text"]
 
     # find earliest punctuation after the `max_len` char mark and cut off
-    if len(quote_data["text"]) > max_len:
+    if len(quote_text) > max_len:
         mark = max_len
-        for i, c in enumerate(quote_data["text"][max_len:]):
+        for i, c in enumerate(quote_text[max_len:]):
             if c in (";", ",", ".", "/"):
                 mark += i
                 break
 
-        quote_data["text"] = quote_data["text"][:mark] + "..."
+        quote_text = quote_text[:mark] + "..."
 
     html = (
         '<div style="background-color: transparent; margin: auto; padding: 20px;">'
         '<blockquote style="margin-bottom: 2em"><p style="font-size: 1.1rem"><i>'
-        + quote_data["text"]
+        + quote_text
         + f'</i></p><cite style="font-size: 1rem">— {quote_data["author"]}, {quote_data["title"]}</cite></blockquote><hr>'
         + html
         + "</div>"
     )
 
-    return html, color
+    return html
 
 
 def jsonify_html(html_string):
@@ -612,144 +1842,979 @@ def jsonify_html(html_string):
     return element_to_dict(soup)
 
 
-def get_exa_webpages(email_text):
-    def exa_post(url, headers, body, result_key):
-        response = requests.post(url, headers=headers, json=body)
-        if response.status_code != 200:
-            print(f"error: exa.ai request failed -- {response.text}")
-            if "API key usage limit reached" not in response.text:
-                print('url: "' + url + '"')
-                print('body: "' + str(body) + '"')
-            return []
+EXA_SEARCH_URL = "https://api.exa.ai/search"
+EXA_CONTENTS_URL = "https://api.exa.ai/contents"
+EXA_CONTENTS_MAX_CHARACTERS = 512
+
+# search results are keyed by a hash of the query, page contents by exa id
+# entries are re-queried by every newsletter path and retry within a week,
+# and the same pages keep coming back week after week
+EXA_CACHE_PATH = os.environ.get(
+    "RITUAL_EXA_CACHE_PATH", os.path.join(BASE_DIR, "cache", "exa.sqlite3")
+)
+EXA_SEARCH_TTL = int(os.environ.get("RITUAL_EXA_SEARCH_TTL", 3 * 24 * 3600))
+EXA_CONTENTS_TTL = int(os.environ.get("RITUAL_EXA_CONTENTS_TTL", 30 * 24 * 3600))
+EXA_SEARCH_CACHE_SIZE = 20000
+EXA_CONTENTS_CACHE_SIZE = 100000
 
-        return response.json()[result_key]
 
-    query = email_text + "\n---\nHere's a link most relevant to the above entry: "
+@functools.cache
+def exa_search_cache():
+    return TTLCache(EXA_CACHE_PATH, "exa_search", EXA_SEARCH_TTL, EXA_SEARCH_CACHE_SIZE)
+
+
+@functools.cache
+def exa_contents_cache():
+    return TTLCache(
+        EXA_CACHE_PATH,
+        f"exa_contents_{EXA_CONTENTS_MAX_CHARACTERS}",
+        EXA_CONTENTS_TTL,
+        EXA_CONTENTS_CACHE_SIZE,
+    )
 
-    headers = {
+
+def exa_search_key(body):
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# only what `exa_contents_body` needs is kept
+def cache_exa_search(key, webpages):
+    exa_search_cache().set(
+        key, [{"id": x["id"], "score": x["score"]} for x in webpages]
+    )
+
+
+def cache_exa_pages(page_contents):
+    exa_contents_cache().set_many(
+        {
+            x["id"]: {"url": x["url"], "title": x["title"], "text": x["text"]}
+            for x in page_contents
+        }
+    )
+
+
+def exa_headers():
+    return {
         "accept": "application/json",
         "content-type": "application/json",
         "x-api-key": os.environ["EXAI_API_KEY"],
     }
 
-    body = {"query": query, "category": "personal site"}
 
-    webpages = exa_post("https://api.exa.ai/search", headers, body, "results")
+def exa_search_body(email_text):
+    query = email_text + "\n---\nHere's a link most relevant to the above entry: "
+
+    return {"query": query, "category": "personal site"}
+
 
-    # make a random selection from the top N results
+# make a random selection from the top N results
+def exa_contents_body(webpages):
     webpages = sorted(webpages, key=lambda x: x["score"], reverse=True)[:30]
     webpages = random.sample(webpages, min(10, len(webpages)))
     page_ids = [x["id"] for x in webpages]
 
-    contents_body = {"ids": page_ids, "text": {"maxCharacters": 512}}
+    return {"ids": page_ids, "text": {"maxCharacters": EXA_CONTENTS_MAX_CHARACTERS}}
 
-    page_contents = exa_post(
-        "https://api.exa.ai/contents", headers, contents_body, "results"
-    )
 
+class ExaRequestError(Exception):
+    def __init__(self, response):
+        super().__init__(f"exa.ai request failed -- {response.text}")
+        self.status_code = response.status_code
+
+
+class ExaQuotaExceeded(Exception):
+    pass
+
+
+# raises for statuses worth retrying; an exhausted quota opens the breaker
+# for `EXA_QUOTA_COOLDOWN` so later entries and users skip Exa entirely
+def check_exa_response(response):
+    if response.status_code == 200:
+        return response
+
+    if "API key usage limit reached" in response.text:
+        BREAKERS["exa"].trip(EXA_QUOTA_COOLDOWN)
+        raise ExaQuotaExceeded(response.text)
+
+    if response.status_code == 429 or response.status_code >= 500:
+        raise ExaRequestError(response)
+
+    return response
+
+
+# None when the request failed, so failures aren't cached as empty results
+def exa_results(response, url, body, result_key):
+    if response.status_code != 200:
+        print(f"error: exa.ai request failed -- {response.text}")
+        if "API key usage limit reached" not in response.text:
+            print('url: "' + url + '"')
+            print('body: "' + str(body) + '"')
+        return None
+
+    return response.json()[result_key]
+
+
+def format_exa_pages(page_contents):
     return [
         {"url": x["url"], "title": x["title"], "text": x["text"]} for x in page_contents
     ]
 
 
-@app.route("/send-newsletters", methods=["POST"])
-@email_auth
-def send_newsletters():
-    end_date = datetime.now()
+# -- newsletter pipeline --
+#
+# every entry point builds its newsletters by running the same stages (see
+# `stages.py`): gather entries, Exa, memory recall and the quote, pack, generate,
+# render, deliver, archive. each entry point picks the stages it needs; Exa,
+# memory recall and the quote don't depend on each other, so they run together,
+# and a batch runs many users at once sharing one http connection pool
 
-    users = User.query.filter_by(active=True, user_id=1).all()
-    print(f"sending newsletters to {[u.username for u in users]}")
+# newsletters generated at once in a batch
+NEWSLETTER_BATCH_CONCURRENCY = int(os.environ.get("RITUAL_NEWSLETTER_CONCURRENCY", 32))
+ASYNC_HTTP_CONNECTIONS = 200
+# pinecone and SES have no async SDKs, their calls run on this pool
+ASYNC_BLOCKING_WORKERS = 64
+
+_blocking_executor = None
+_blocking_executor_lock = threading.Lock()
+
+
+def get_blocking_executor():
+    global _blocking_executor
+
+    with _blocking_executor_lock:
+        if _blocking_executor is None:
+            _blocking_executor = ThreadPoolExecutor(
+                max_workers=ASYNC_BLOCKING_WORKERS, thread_name_prefix="ritual-blocking"
+            )
+
+        return _blocking_executor
+
+
+# runs a blocking call off the event loop, keeping the caller's usage scope
+async def run_blocking(func, *args, **kwargs):
+    context = contextvars.copy_context()
+
+    return await asyncio.get_running_loop().run_in_executor(
+        get_blocking_executor(), functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+# async clients are tied to the event loop that creates them, so each batch
+# builds its own (registered overrides are used as-is and left open)
+@asynccontextmanager
+async def async_clients():
+    import httpx
+    from openai import AsyncOpenAI
+
+    http = _clients.get("async_http")
+    openai = _clients.get("async_openai")
+    owned_http = http is None
+
+    if owned_http:
+        http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_HTTP_CONNECTIONS,
+                max_keepalive_connections=ASYNC_HTTP_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+
+    if openai is None:
+        openai = AsyncOpenAI(http_client=http, max_retries=0)
+
+    try:
+        yield SimpleNamespace(http=http, openai=openai)
+    finally:
+        if owned_http:
+            await http.aclose()
+
+
+async def openai_prompt_async(clients, system_prompt, user_prompt):
+    print("prompting gpt...")
+    oai_response = await guarded_async(
+        "openai",
+        OPENAI_POLICY,
+        lambda timeout: clients.openai.chat.completions.create(
+            model=GPT_MODEL,
+            temperature=TEMPERATURE,
+            messages=chat_messages(system_prompt, user_prompt),
+            timeout=timeout,
+        ),
+    )
+
+    record_completion_usage(oai_response)
+
+    return oai_response.choices[0].message.content
+
+
+async def get_embeddings_async(clients, texts):
+    response = await guarded_async(
+        "openai",
+        EMBEDDING_POLICY,
+        lambda timeout: clients.openai.embeddings.create(
+            input=texts, model=EMBEDDING_MODEL, timeout=timeout
+        ),
+    )
+    record_usage(EMBEDDING_MODEL, response.usage.prompt_tokens)
+
+    return [x.embedding for x in sorted(response.data, key=lambda x: x.index)]
+
+
+# see `embed_chunks`
+async def embed_chunks_async(clients, texts):
+    chunked = [chunk_text(t) for t in texts]
+    flat = [c for chunks in chunked for c in chunks]
+
+    batches = await asyncio.gather(
+        *(
+            get_embeddings_async(clients, flat[i : i + EMBEDDING_BATCH_INPUTS])
+            for i in range(0, len(flat), EMBEDDING_BATCH_INPUTS)
+        )
+    )
+
+    return regroup([v for batch in batches for v in batch], chunked)
+
+
+async def query_index_many_async(index_name, vectors, top_k, filter):
+    return await asyncio.gather(
+        *(run_blocking(query_index, index_name, v, top_k, filter) for v in vectors)
+    )
+
+
+async def get_exa_webpages_async(clients, email_text):
+    async def exa_post(url, headers, body, result_key):
+        async def post(timeout):
+            response = await clients.http.post(
+                url, headers=headers, json=body, timeout=timeout
+            )
+            return check_exa_response(response)
 
-    successes = []
-    for user in users:
         try:
-            emails = get_user_entries_in_range(user.user_id, 7)
-
-            webpages = []
-            for e in emails:
-                webpages += get_exa_webpages(get_db_email_text(e))
-
-            # dirty way to get rid of duplicate urls
-            webpages = {w["url"]: w for w in webpages}
-
-            formatted_email_text = format_emails_for_gpt(emails)
-            if len(emails) > 0:
-                memory_embedding = get_embedding(formatted_email_text)
-
-                memory_ids = [
-                    x["metadata"]["email_id"]
-                    for x in memory_index.query(
-                        vector=memory_embedding,
-                        top_k=3,
-                        include_metadata=True,
-                        filter={
-                            "user_id": {"$eq": emails[0].user_id},
-                            "email_id": {"$nin": [e.email_id for e in emails]},
-                        },
-                    )["matches"]
-                ]
+            response = await guarded_async("exa", EXA_POLICY, post)
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"error: exa.ai request failed -- {e}")
+            return None
 
-                memories = Email.query.filter(Email.email_id.in_(memory_ids)).all()
+        return exa_results(response, url, body, result_key)
 
-                formatted_email_text += "--- Memories ---\n\n"
-                for m in memories:
-                    formatted_email_text += get_db_email_text(m) + "\n---\n"
+    headers = exa_headers()
 
-            formatted_email_text += "--- Webpages ---\n\n"
-            for w in webpages.values():
-                formatted_email_text += (
-                    f"{w['title']} -- {w['url']}\n{w['text']}\n---\n"
-                )
+    search_body = exa_search_body(email_text)
+    search_key = exa_search_key(search_body)
+
+    # the cache is a sqlite file shared with the other workers, its reads and
+    # writes can wait on their locks and stay off the event loop
+    webpages = await run_blocking(exa_search_cache().get, search_key)
+    if webpages is None:
+        webpages = await exa_post(EXA_SEARCH_URL, headers, search_body, "results")
+        if webpages is None:
+            return []
 
-            newsletter, _ = get_newsletter(formatted_email_text)
+        await run_blocking(cache_exa_search, search_key, webpages)
 
-            send_email(
-                f'Ritual Weekly Report {end_date.strftime("%m/%d").lstrip("0").replace("/0", "/")}',
-                newsletter,
-                user.username,
+    if len(webpages) == 0:
+        return []
+
+    contents_body = exa_contents_body(webpages)
+    cached = await run_blocking(exa_contents_cache().get_many, contents_body["ids"])
+    missing = [x for x in contents_body["ids"] if x not in cached]
+
+    page_contents = []
+    if len(missing) > 0:
+        page_contents = (
+            await exa_post(
+                EXA_CONTENTS_URL, headers, contents_body | {"ids": missing}, "results"
             )
+            or []
+        )
+        await run_blocking(cache_exa_pages, page_contents)
+
+    return list(cached.values()) + format_exa_pages(page_contents)
+
+
+async def get_quote_async(clients, text):
+    vectors = (await embed_chunks_async(clients, [text]))[0]
+    responses = await query_index_many_async(
+        "pc_index", vectors, QUOTE_TOP_K, QUOTE_FILTER
+    )
+
+    return pick_quote({"matches": fuse_matches(responses, QUOTE_TOP_K)})
+
+
+async def get_color_async(clients, text):
+    return normalize_color(await openai_prompt_async(clients, COLOR_PROMPT, text))
+
+
+MEMORY_RECALL_K = 3
+
+
+# email ids of the user's past entries most similar to `text`, each chunk of
+# `text` recalls on its own and the results are fused
+async def recall_memory_ids_async(clients, user_id, text, exclude_email_ids):
+    vectors = (await embed_chunks_async(clients, [text]))[0]
+    responses = await query_index_many_async(
+        "memory_index",
+        vectors,
+        # entries are stored as several chunks, so ask for more to fill k emails
+        MEMORY_RECALL_K * 2,
+        memory_filter(user_id, exclude_email_ids),
+    )
+    matches = fuse_matches(
+        responses, MEMORY_RECALL_K, key=lambda match: match["metadata"]["email_id"]
+    )
+
+    return [x["metadata"]["email_id"] for x in matches]
+
+
+# one user's newsletter as it moves through the stages, `newsletter_job` sets
+# the inputs and each stage fills in its part of the rest
+class NewsletterJob:
+    def __init__(
+        self,
+        user_id,
+        username,
+        route,
+        subject,
+        include_stored=True,
+        extra_entries=(),
+        include_exa=True,
+        packing_budget=None,
+        scheduled_for=None,
+        tree=False,
+    ):
+        self.user_id = user_id
+        self.username = username
+        self.route = route
+        self.subject = subject
+        # the last 7 days of emailed entries
+        self.include_stored = include_stored
+        # (date, text) pairs sent along with the request, e.g. from the cli
+        self.extra_entries = list(extra_entries)
+        self.include_exa = include_exa
+        self.packing_budget = packing_budget
+        self.scheduled_for = scheduled_for
+        # also build the html as a tree for the web app
+        self.tree = tree
+
+        self.clients = None
+        self.emails = []
+        self.entries = []
+        self.formatted_text = None
+        self.webpages = []
+        self.memories = []
+        self.quote = None
+        self.prompt = None
+        self.summary = None
+        self.color = None
+        self.newsletter = None
+        self.html_tree = None
+        self.archived = None
+
+
+# users past their budget get the cheaper newsletter (no Exa, smaller input)
+def newsletter_job(user, route, subject, packing_budget=None, **kwargs):
+    job = NewsletterJob(
+        user.user_id,
+        user.username,
+        route,
+        subject,
+        packing_budget=packing_budget,
+        **kwargs,
+    )
+
+    if user_over_budget(user.user_id):
+        job.include_exa = False
+        job.packing_budget = min(
+            packing_budget or REDUCED_PACKING_BUDGET, REDUCED_PACKING_BUDGET
+        )
+
+    return job
+
+
+def weekly_report_subject(date, prefix=""):
+    return f'{prefix}Ritual Weekly Report {date.strftime("%m/%d").lstrip("0").replace("/0", "/")}'
+
+
+# database reads stay on the event loop thread, which holds the app context
+def gather_entries(job):
+    entries = []
+    if job.include_stored:
+        job.emails = get_user_entries_in_range(job.user_id, 7)
+        entries = [(e.creation_date, get_db_email_text(e)) for e in job.emails]
+
+    job.entries = entries + job.extra_entries
+    job.formatted_text = format_entries(job.entries)
+
+
+async def search_webpages(job):
+    if not job.include_exa:
+        return
+
+    results = await asyncio.gather(
+        *(get_exa_webpages_async(job.clients, text) for _, text in job.entries)
+    )
+
+    # dirty way to get rid of duplicate urls
+    job.webpages = list({w["url"]: w for pages in results for w in pages}.values())
+
+
+# memories are a nice-to-have, a failing recall shouldn't sink the newsletter
+async def recall_memories(job):
+    if len(job.emails) == 0:
+        return
+
+    try:
+        memory_ids = await recall_memory_ids_async(
+            job.clients,
+            job.user_id,
+            job.formatted_text,
+            [e.email_id for e in job.emails],
+        )
+    except Exception as e:
+        print(f"skipping memories for user id {job.user_id}: {e}")
+        return
+
+    job.memories = [
+        get_db_email_text(m)
+        for m in Email.query.filter(Email.email_id.in_(memory_ids)).all()
+    ]
+
+
+async def find_quote(job):
+    job.quote = await get_quote_async(job.clients, job.formatted_text)
+
+
+# entries first, cut to the packing budget, then whole memories and webpages
+# for as long as they fit
+def pack_prompt(job):
+    budget = job.packing_budget
+
+    prompt = job.formatted_text
+    if budget is not None:
+        prompt = prompt[:budget]
+
+    sections = (
+        ("--- Memories ---\n\n", [m + "\n---\n" for m in job.memories]),
+        (
+            "--- Webpages ---\n\n",
+            [f"{w['title']} -- {w['url']}\n{w['text']}\n---\n" for w in job.webpages],
+        ),
+    )
+    for header, pieces in sections:
+        if len(pieces) == 0:
+            continue
+
+        prompt += header
+        for piece in pieces:
+            if budget is not None and len(prompt) + len(piece) >= budget:
+                break
+
+            prompt += piece
+
+    job.prompt = prompt
+
+
+# can we do this without prompting gpt twice?
+async def generate_newsletter(job):
+    job.summary, job.color = await asyncio.gather(
+        openai_prompt_async(job.clients, EthosDefault.summary(), job.prompt),
+        get_color_async(job.clients, job.quote["text"][:QUOTE_MAX_LEN]),
+    )
+
+
+def render_job(job):
+    job.newsletter = render_newsletter(job.summary, job.quote)
+    if job.tree:
+        job.html_tree = jsonify_html(job.newsletter)
+
+
+def deliver_job(job):
+    send_email(job.subject, job.newsletter, job.username)
+
+
+# added to the caller's session, committed by the caller
+def archive_job(job):
+    job.archived = archive_newsletter(
+        job.user_id, job.subject, job.newsletter, job.color, job.scheduled_for
+    )
 
-            user.last_newsletter = datetime.now()
+    if job.scheduled_for is None:
+        db.session.get(User, job.user_id).last_newsletter = datetime.now()
 
-            if not user.archiving:
-                successes += emails
+
+# markdown and html parsing hold the GIL, a small pool of their own keeps them
+# from crowding out the pinecone and SES calls on the blocking pool
+RENDER_WORKERS = 4
+
+
+@functools.cache
+def get_render_executor():
+    return ThreadPoolExecutor(
+        max_workers=RENDER_WORKERS, thread_name_prefix="ritual-render"
+    )
+
+
+# jobs a stage works on at once across a batch, overridden with e.g.
+# RITUAL_STAGE_CONCURRENCY="exa=4,deliver=8"
+STAGE_CONCURRENCY = {
+    "exa": 16,
+    "memory": 32,
+    "quote": 32,
+    "generate": 32,
+    "render": RENDER_WORKERS,
+    # SES' default sending rate is 14 emails a second
+    "deliver": 14,
+} | {
+    name: int(limit)
+    for name, _, limit in (
+        x.partition("=")
+        for x in os.environ.get("RITUAL_STAGE_CONCURRENCY", "").split(",")
+        if x
+    )
+}
+
+
+def stage(name, func, executor=None):
+    return Stage(name, func, executor, STAGE_CONCURRENCY.get(name))
+
+
+GATHER = stage("gather", gather_entries, INLINE)
+EXA = stage("exa", search_webpages)
+MEMORY = stage("memory", recall_memories)
+QUOTE = stage("quote", find_quote)
+PACK = stage("pack", pack_prompt, INLINE)
+GENERATE = stage("generate", generate_newsletter)
+RENDER = stage("render", render_job, get_render_executor)
+DELIVER = stage("deliver", deliver_job, get_blocking_executor)
+ARCHIVE = stage("archive", archive_job, INLINE)
+
+
+@contextmanager
+def newsletter_scope(job):
+    with usage_scope(job.user_id, job.route), resilience.deadline(
+        NEWSLETTER_DEADLINE_SECONDS
+    ):
+        yield
+
+
+# per stage timings of every pipeline since the process started
+NEWSLETTER_TIMINGS = StageTimings()
+
+# the weekly batch skips Exa by default, it costs a search and a contents call
+# per user every week
+PREPARE_EXA = os.environ.get("RITUAL_PREPARE_EXA", "0") == "1"
+
+# the stages each entry point runs, keyed by route
+NEWSLETTER_PIPELINES = {
+    route: Pipeline(route, steps, NEWSLETTER_TIMINGS, scope=newsletter_scope)
+    for route, steps in {
+        "send_newsletters": [
+            GATHER,
+            (EXA, MEMORY, QUOTE),
+            PACK,
+            GENERATE,
+            RENDER,
+            DELIVER,
+            ARCHIVE,
+        ],
+        # released at the user's send time by `release_newsletter_batch`
+        "prepare_newsletters": [
+            GATHER,
+            (EXA, MEMORY, QUOTE) if PREPARE_EXA else (MEMORY, QUOTE),
+            PACK,
+            GENERATE,
+            RENDER,
+            ARCHIVE,
+        ],
+        "cli_newsletters": [GATHER, QUOTE, PACK, GENERATE, RENDER, DELIVER, ARCHIVE],
+        # returned to the web app rather than emailed
+        "web_newsletter": [GATHER, (EXA, QUOTE), PACK, GENERATE, RENDER, ARCHIVE],
+        "send_test_newsletters": [GATHER, QUOTE, PACK, GENERATE, RENDER, DELIVER],
+    }.items()
+}
+
+
+# returns each job, or the exception that stopped it, in order
+def run_newsletter_jobs(route, jobs, concurrency=NEWSLETTER_BATCH_CONCURRENCY):
+    if len(jobs) == 0:
+        return []
+
+    async def run():
+        async with async_clients() as clients:
+            for job in jobs:
+                job.clients = clients
+
+            return await NEWSLETTER_PIPELINES[route].run(jobs, concurrency)
+
+    return asyncio.run(run())
+
+
+# kept for the account export, committed with the caller's transaction
+# newsletters generated ahead of time are archived unsent, with `scheduled_for`
+def archive_newsletter(user_id, subject, html, color, scheduled_for=None):
+    newsletter = Newsletter(
+        user_id=user_id,
+        subject=subject,
+        html=html,
+        color=color,
+        scheduled_for=scheduled_for,
+        sent_at=datetime.now() if scheduled_for is None else None,
+    )
+    db.session.add(newsletter)
+
+    return newsletter
+
+
+# runs `route` for `users`, `subjects` maps user_id -> subject and
+# `scheduled_for` user_id -> send time; returns the jobs that succeeded
+def generate_newsletter_batch(users, route, subjects, scheduled_for=None):
+    jobs = []
+    for user in users:
+        try:
+            jobs.append(
+                newsletter_job(
+                    user,
+                    route,
+                    subjects[user.user_id],
+                    scheduled_for=(scheduled_for or {}).get(user.user_id),
+                )
+            )
         except Exception as e:
             print(f"error generating newsletter for {user.username}: {e}")
 
-    try:
-        for email in successes:
-            db.session.delete(email)
+    results = run_newsletter_jobs(route, jobs)
+    print(f"`{route}` stage timings:\n{NEWSLETTER_TIMINGS.summary(route)}")
+
+    successes = []
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"error generating newsletter for {job.username}: {result}")
+            continue
+
+        successes.append(job)
+
+    return successes
+
+
+# a claim has to finish within its lease, or another worker runs it again
+NEWSLETTER_TASK_LEASE = NEWSLETTER_DEADLINE_SECONDS * 2
+NEWSLETTER_TASK_ATTEMPTS = 3
+# tasks a worker claims at once, run through the pipeline together
+NEWSLETTER_CLAIM_SIZE = int(os.environ.get("RITUAL_NEWSLETTER_CLAIM_SIZE", 20))
+NEWSLETTER_TASK_RETENTION = timedelta(days=14)
+
+
+@functools.cache
+def newsletter_queue():
+    return WorkQueue(
+        lambda: db.engine,
+        NewsletterTask.__table__,
+        NEWSLETTER_TASK_LEASE,
+        NEWSLETTER_TASK_ATTEMPTS,
+    )
+
+
+# queues a newsletter for each of `users` that doesn't already have one of
+# `route` waiting or running; `scheduled_for` maps user_id -> send time for
+# newsletters generated ahead of their delivery. returns the queued task ids
+def enqueue_newsletters(route, users, scheduled_for=None):
+    queued = {
+        user_id
+        for (user_id,) in db.session.query(NewsletterTask.user_id).filter(
+            NewsletterTask.route == route,
+            NewsletterTask.status.in_((PENDING, LEASED)),
+        )
+    }
+
+    user_ids = [user.user_id for user in users if user.user_id not in queued]
+    task_ids = []
+    for user_id in user_ids:
+        task = NewsletterTask(
+            route=route,
+            user_id=user_id,
+            scheduled_for=(scheduled_for or {}).get(user_id),
+        )
+        db.session.add(task)
+
+        # one commit per task, when another node queues the same send time at
+        # once only the duplicate is rejected
+        try:
+            db.session.commit()
+            task_ids.append(task.task_id)
+        except sa.exc.IntegrityError:
+            db.session.rollback()
+
+    return task_ids
+
+
+# generates and delivers the newsletters of `tasks`, their results and their
+# completion are committed together
+def run_newsletter_tasks(route, tasks):
+    queue = newsletter_queue()
+    users = {
+        user.user_id: user
+        for user in User.query.filter(User.user_id.in_([t.user_id for t in tasks]))
+    }
+    now = datetime.now()
+
+    done = []
+    queued = []
+    for task in tasks:
+        user = users.get(task.user_id)
+        if user is None or not user.active:
+            # unsubscribed since it was queued
+            done.append(task)
+            continue
+
+        subject = weekly_report_subject(now)
+        if task.scheduled_for is not None:
+            # dated in the user's zone on the day it goes out
+            subject = weekly_report_subject(
+                task.scheduled_for.replace(tzinfo=UTC).astimezone(user_zone(user))
+            )
+
+        queued.append(
+            (
+                task,
+                newsletter_job(
+                    user, route, subject, scheduled_for=task.scheduled_for
+                ),
+            )
+        )
+
+    results = run_newsletter_jobs(route, [job for _, job in queued])
+    for (task, job), result in zip(queued, results):
+        if isinstance(result, Exception):
+            print(f"error generating newsletter for {job.username}: {result}")
+            queue.fail(db.session, task, str(result)[:1000])
+            continue
+
+        done.append(task)
+        # prepared newsletters drop their entries once they're released
+        if task.scheduled_for is None and not users[task.user_id].archiving:
+            delete_emails(job.emails)
+
+    queue.complete(db.session, done)
+    db.session.commit()
+
+
+# claims and works tasks until the queue is empty or `max_tasks` have run,
+# alongside whichever other workers are draining it; `task_ids` limits it to
+# those tasks. returns the tasks worked
+def drain_newsletter_queue(max_tasks=None, task_ids=None):
+    where = []
+    if task_ids is not None:
+        where.append(NewsletterTask.task_id.in_(task_ids))
+
+    worked = 0
+    while max_tasks is None or worked < max_tasks:
+        limit = NEWSLETTER_CLAIM_SIZE
+        if max_tasks is not None:
+            limit = min(limit, max_tasks - worked)
+
+        tasks = newsletter_queue().claim(limit, *where)
+        if len(tasks) == 0:
+            break
+
+        routes = {}
+        for task in tasks:
+            routes.setdefault(task.route, []).append(task)
+
+        for route, route_tasks in routes.items():
+            run_newsletter_tasks(route, route_tasks)
+            print(f"`{route}` stage timings:\n{NEWSLETTER_TIMINGS.summary(route)}")
+
+        worked += len(tasks)
+
+    return worked
+
+
+# how far ahead of a user's send time their newsletter may be generated
+PREPARE_LOOKAHEAD = timedelta(hours=6)
+# per run, spreads users sharing a send time over several runs
+PREPARE_BATCH_LIMIT = int(os.environ.get("RITUAL_PREPARE_BATCH_LIMIT", "200"))
+RELEASE_BATCH_LIMIT = 500
+
+
+# active users due a newsletter within `PREPARE_LOOKAHEAD`, soonest first, as
+# (send time, user). a user is skipped while a newsletter of theirs is waiting
+# to go out, or once this send time has been queued or sent; like the old
+# catch-up run, one sent (e.g. from the web) in the last day also counts
+def users_to_prepare(now):
+    users = User.query.filter(
+        User.active, User.last_newsletter < now - timedelta(days=1)
+    ).all()
+
+    waiting = set()
+    prepared = set()
+    # every send time `scheduled_send_time` can return is after this
+    since = now - DELIVERY_GRACE
+    ids = [u.user_id for u in users]
+    for i in range(0, len(ids), 1000):
+        chunk = ids[i : i + 1000]
+        waiting.update(
+            user_id
+            for (user_id,) in db.session.query(Newsletter.user_id).filter(
+                Newsletter.sent_at.is_(None), Newsletter.user_id.in_(chunk)
+            )
+        )
+        waiting.update(
+            user_id
+            for (user_id,) in db.session.query(NewsletterTask.user_id).filter(
+                NewsletterTask.route == "prepare_newsletters",
+                NewsletterTask.status.in_((PENDING, LEASED)),
+                NewsletterTask.user_id.in_(chunk),
+            )
+        )
+        prepared.update(
+            (user_id, send)
+            for user_id, send in db.session.query(
+                Newsletter.user_id, Newsletter.scheduled_for
+            ).filter(Newsletter.scheduled_for >= since, Newsletter.user_id.in_(chunk))
+        )
+        # failed ones included, the send time can't be queued again
+        prepared.update(
+            (user_id, send)
+            for user_id, send in db.session.query(
+                NewsletterTask.user_id, NewsletterTask.scheduled_for
+            ).filter(
+                NewsletterTask.route == "prepare_newsletters",
+                NewsletterTask.scheduled_for >= since,
+                NewsletterTask.user_id.in_(chunk),
+            )
+        )
+
+    due = []
+    for user in users:
+        if user.user_id in waiting:
+            continue
+
+        send = scheduled_send_time(user, now)
+        if send <= now + PREPARE_LOOKAHEAD and (user.user_id, send) not in prepared:
+            due.append((send, user))
+
+    due.sort(key=lambda x: x[0])
+
+    return due
+
+
+# queues the newsletters of users coming due, whichever workers drain the queue
+# generate them to be released at their send time; returns how many were queued
+def prepare_newsletter_batch(now, limit=PREPARE_BATCH_LIMIT):
+    due = users_to_prepare(now)[:limit]
+    if len(due) == 0:
+        return 0
+
+    queued = enqueue_newsletters(
+        "prepare_newsletters",
+        [user for _, user in due],
+        scheduled_for={user.user_id: send for send, user in due},
+    )
+    print(f"queued newsletters for {len(queued)} users")
+
+    return len(queued)
+
+
+# sends prepared newsletters whose time has come. every node runs this, so each
+# newsletter is claimed by setting `sent_at` before it's sent and only the
+# node whose claim lands sends it; a crash between the two loses that one
+# newsletter rather than sending it twice
+def release_newsletter_batch(now, limit=RELEASE_BATCH_LIMIT):
+    due = (
+        Newsletter.query.filter(
+            Newsletter.sent_at.is_(None), Newsletter.scheduled_for <= now
+        )
+        .order_by(Newsletter.scheduled_for)
+        .limit(limit)
+        .all()
+    )
+
+    released = 0
+    for newsletter in due:
+        claimed = db.session.execute(
+            sa.update(Newsletter)
+            .where(
+                Newsletter.newsletter_id == newsletter.newsletter_id,
+                Newsletter.sent_at.is_(None),
+            )
+            .values(sent_at=now)
+        ).rowcount
+        db.session.commit()
+        if claimed != 1:
+            continue
+
+        user = db.session.get(User, newsletter.user_id)
+        if not user.active:
+            # unsubscribed after it was generated
+            db.session.delete(newsletter)
+            db.session.commit()
+            continue
+
+        try:
+            send_email(newsletter.subject, newsletter.html, user.username)
+        except Exception as e:
+            print(f"error releasing newsletter for {user.username}: {e}")
+            # back for the next run to try again
+            newsletter.sent_at = None
+            db.session.commit()
+            continue
+
+        user.last_newsletter = now
+
+        # the entries that went into it, anything logged since is kept for next week
+        if not user.archiving:
+            delete_emails(
+                Email.query.filter(
+                    Email.user_id == user.user_id,
+                    Email.creation_date <= newsletter.creation_date,
+                ).all()
+            )
+
+        db.session.commit()
+        released += 1
+
+    return released
+
+
+@app.route("/send-newsletters", methods=["POST"])
+@email_auth
+def send_newsletters():
+    users = User.query.filter_by(active=True, user_id=1).all()
+    print(f"sending newsletters to {[u.username for u in users]}")
 
-        db.session.commit()
-    except Exception as e:
-        print(
-            f"error deleting email id {email.email_id} for user id {email.user_id}: {e}"
-        )
+    # only what this call queued, the rest of the queue (e.g. the weekly batch)
+    # is left to the workers rather than run inside the request
+    task_ids = enqueue_newsletters("send_newsletters", users)
+    drain_newsletter_queue(len(task_ids), task_ids)
 
     return "success", 200
 
 
 @app.route("/cli-newsletters", methods=["POST"])
 @cli_auth
+@with_deadline(REQUEST_DEADLINE_SECONDS)
 def cli_newsletters():
-    # get and format any emails from the last 7 days
-    emails = get_user_entries_in_range(request.user_id, 7)
-    formatted_email_text = format_emails_for_gpt(emails)
-    formatted_email_text += "\n\n".join(
-        [f"{e['date']} -- {e['text']}" for e in request.json["entries"]]
-    )
-
     user = User.query.filter_by(user_id=request.user_id).first()
     print(f"preparing email for user {user.username}")
 
+    job = newsletter_job(
+        user,
+        "cli_newsletters",
+        weekly_report_subject(datetime.now()),
+        extra_entries=[(e["date"], e["text"]) for e in request.json["entries"]],
+    )
+
     try:
-        send_email(
-            f'Ritual Weekly Report {datetime.now().strftime("%m/%d").lstrip("0").replace("/0", "/")}',
-            get_newsletter(formatted_email_text)[0],
-            user.username,
-        )
+        result = run_newsletter_jobs("cli_newsletters", [job])[0]
+        if isinstance(result, Exception):
+            raise result
 
-        user.last_newsletter = datetime.now()
+        # the prepared one would otherwise go out shortly after
+        Newsletter.query.filter(
+            Newsletter.user_id == user.user_id, Newsletter.sent_at.is_(None)
+        ).delete()
 
         db.session.commit()
 
@@ -771,6 +2836,8 @@ def create_token(user_id):
 
 
 @app.route("/get-config-token", methods=["GET"])
+@rate_limited(CONFIG_TOKEN_IP_LIMIT, client_ip)
+@rate_limited(CONFIG_TOKEN_ACCOUNT_LIMIT, query_arg("email"))
 def user_config():
     username = request.args.get("email", None)
     if username is None:
@@ -800,8 +2867,12 @@ def user_config():
 def update_settings():
     if request.json["delete_user"]:
         print(f"deleting user id {request.user_id}")
+        delete_emails(Email.query.filter_by(user_id=request.user_id).all())
         user_data = (
-            Email.query.filter_by(user_id=request.user_id).all()
+            EmotionWeek.query.filter_by(user_id=request.user_id).all()
+            + NewsletterRequest.query.filter_by(user_id=request.user_id).all()
+            + NewsletterTask.query.filter_by(user_id=request.user_id).all()
+            + Newsletter.query.filter_by(user_id=request.user_id).all()
             + User.query.filter_by(user_id=request.user_id).all()
         )
 
@@ -844,6 +2915,23 @@ def update_settings():
     user.active = request.json["receiving_newsletters"]
     user.archiving = not request.json["deleting_data"]
 
+    # both optional, older clients don't send them
+    try:
+        if "timezone" in request.json:
+            user.timezone = ZoneInfo(request.json["timezone"]).key
+        if "delivery_time" in request.json:
+            user.delivery_time = time.fromisoformat(request.json["delivery_time"])
+    except (ZoneInfoNotFoundError, ValueError, TypeError) as e:
+        print(f"update_settings error: {e}")
+
+        return "error", 400
+
+    # a newsletter already generated goes out at the new time
+    for newsletter in Newsletter.query.filter(
+        Newsletter.user_id == user.user_id, Newsletter.sent_at.is_(None)
+    ).all():
+        newsletter.scheduled_for = scheduled_send_time(user, utc_now())
+
     try:
         db.session.commit()
 
@@ -853,7 +2941,7 @@ def update_settings():
 
         send_email(
             "Updated Account Settings",
-            f"Your account settings have been updated to reflect the following values:<ul><li>Receiving newsletters: <b>{user.active}</b><li>Receiving log receipts: <b>{user.receiving_logs}</b></ul>",
+            f"Your account settings have been updated to reflect the following values:<ul><li>Receiving newsletters: <b>{user.active}</b><li>Receiving log receipts: <b>{user.receiving_logs}</b><li>Delivery: <b>Sundays at {user.delivery_time.strftime('%H:%M')} ({user.timezone})</b></ul>",
             user.username,
         )
 
@@ -864,6 +2952,179 @@ def update_settings():
         return "error", 400
 
 
+EXPORT_PAGE_SIZE = 500
+# full messages can run to megabytes each
+EXPORT_MESSAGE_PAGE_SIZE = 20
+
+
+# yields `model` rows owned by `user_id` in primary key order, a page at a time
+# each page is a short keyset query streamed off a server-side cursor in a
+# transaction of its own, and is dropped from the session before the next one
+# is read, so a slow download doesn't hold a transaction open
+def iter_user_rows(model, key, user_id, page_size=EXPORT_PAGE_SIZE, options=()):
+    last = None
+    while True:
+        query = sa.select(model).options(*options).where(model.user_id == user_id)
+        if last is not None:
+            query = query.where(key > last)
+
+        rows = db.session.scalars(
+            query.order_by(key)
+            .limit(page_size)
+            .execution_options(yield_per=page_size)
+        )
+
+        count = 0
+        for row in rows:
+            count += 1
+            last = getattr(row, key.key)
+            yield row
+
+        # read-only, ending the transaction releases its snapshot and locks
+        db.session.expunge_all()
+        db.session.rollback()
+        if count < page_size:
+            return
+
+
+def format_export_date(date):
+    return date.isoformat() if date is not None else None
+
+
+# `messages` adds each entry's original MIME message, attachments included
+def export_records(user_id, messages=False):
+    user = db.session.get(User, user_id)
+    yield {
+        "type": "account",
+        "username": user.username,
+        "receiving_newsletters": user.active,
+        "receiving_logs": user.receiving_logs,
+        "archiving": user.archiving,
+        "last_active": format_export_date(user.last_active),
+        "last_newsletter": format_export_date(user.last_newsletter),
+        "timezone": user.timezone,
+        "delivery_time": user.delivery_time.strftime("%H:%M"),
+    }
+
+    for email in iter_user_rows(Email, Email.email_id, user_id):
+        yield {
+            "type": "email",
+            "email_id": email.email_id,
+            "created": format_export_date(email.creation_date),
+            "imported": bool(email.imported_data),
+            "text": get_db_email_text(email),
+        }
+
+    for newsletter in iter_user_rows(Newsletter, Newsletter.newsletter_id, user_id):
+        yield {
+            "type": "newsletter",
+            "newsletter_id": newsletter.newsletter_id,
+            "created": format_export_date(newsletter.creation_date),
+            "subject": newsletter.subject,
+            "sent": format_export_date(newsletter.sent_at),
+            "color": newsletter.color,
+            "html": newsletter.html,
+        }
+
+    if not messages:
+        return
+
+    for email in iter_user_rows(
+        Email,
+        Email.email_id,
+        user_id,
+        EXPORT_MESSAGE_PAGE_SIZE,
+        options=(db.undefer(Email.raw_email_compressed),),
+    ):
+        # imported entries are plain text, already in their email record
+        if email.imported_data:
+            continue
+
+        yield {
+            "type": "message",
+            "email_id": email.email_id,
+            "eml": restore_attachments(email.raw_email),
+        }
+
+
+def export_ndjson(records):
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+# write-only file object for `zipfile`, whatever was written is taken with `drain`
+class ZipSink:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+# one ndjson file per record type, compressed as it is produced; messages are
+# written as they are, one .eml file each
+def export_zip(records):
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        current, entry = None, None
+        for record in records:
+            if record["type"] == "message":
+                if entry is not None:
+                    entry.close()
+                    current, entry = None, None
+
+                archive.writestr(f"messages/{record['email_id']}.eml", record["eml"])
+            else:
+                if record["type"] != current:
+                    if entry is not None:
+                        entry.close()
+
+                    current = record["type"]
+                    entry = archive.open(f"{current}s.ndjson", "w", force_zip64=True)
+
+                entry.write((json.dumps(record) + "\n").encode("utf-8"))
+
+            yield from sink.drain()
+
+        if entry is not None:
+            entry.close()
+
+    yield from sink.drain()
+
+
+# streams everything stored for the account: settings, entries and newsletters,
+# and with ?format=zip the original messages
+#   GET /export?format=ndjson (default) or ?format=zip
+@app.route("/export", methods=["GET"])
+@token_auth
+@rate_limited(EXPORT_LIMIT, authenticated_user)
+def export_account():
+    user_id = request.user_id
+    print(f"exporting data for user id {user_id}")
+
+    stamp = datetime.now().strftime(DATE_FORMAT)
+    if request.args.get("format", "ndjson") == "zip":
+        body = export_zip(export_records(user_id, messages=True))
+        mimetype, filename = "application/zip", f"ritual-export-{stamp}.zip"
+    else:
+        body = export_ndjson(export_records(user_id))
+        mimetype, filename = "application/x-ndjson", f"ritual-export-{stamp}.ndjson"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.route("/generate-cli-token", methods=["GET"])
 @token_auth
 def generate_cli_token():
@@ -893,17 +3154,41 @@ def user_lookup():
     )
 
 
+# bcrypt cost of new hashes, older ones are rehashed on their next login
+BCRYPT_ROUNDS = int(os.environ.get("RITUAL_BCRYPT_ROUNDS", 12))
+# processes hashing passwords in each gunicorn worker, 0 hashes on the request
+# thread. every worker has its own pool, so a host runs workers times this many
+BCRYPT_WORKERS = int(os.environ.get("RITUAL_BCRYPT_WORKERS", 1))
+
+password_hasher = PasswordHasher(BCRYPT_ROUNDS, BCRYPT_WORKERS)
+atexit.register(password_hasher.shutdown)
+
+
+def password_pool_busy():
+    return "Service Unavailable", 503, {"Retry-After": "1"}
+
+
 @app.route("/web-login", methods=["POST"])
+@rate_limited(LOGIN_IP_LIMIT, client_ip)
+@rate_limited(LOGIN_ACCOUNT_LIMIT, json_field("email"))
 def web_login():
     email = request.json["email"]
     password = request.json["password"]
 
     user = User.query.filter_by(username=email).first()
-    if user is None:
+    if user is None or user.web_secret is None:
         return "Unauthorized", 401
 
-    if bcrypt.checkpw(password.encode("utf-8"), bytes(user.web_secret, "utf-8")):
+    try:
+        matches, rehashed = password_hasher.verify(password, user.web_secret)
+    except PoolBusy:
+        return password_pool_busy()
+
+    if matches:
         try:
+            if rehashed is not None:
+                user.web_secret = rehashed
+
             token = create_token(user.user_id)
             db.session.add(token)
             db.session.commit()
@@ -916,6 +3201,8 @@ def web_login():
 
 
 @app.route("/web-register", methods=["POST"])
+@rate_limited(REGISTER_IP_LIMIT, client_ip)
+@rate_limited(REGISTER_ACCOUNT_LIMIT, json_field("email"))
 def web_register():
     email = request.json["email"]
     password = request.json["password"]
@@ -929,7 +3216,11 @@ def web_register():
 
             return str(e), 400
 
-    user.web_secret = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    try:
+        user.web_secret = password_hasher.hash(password)
+    except PoolBusy:
+        return password_pool_busy()
+
     token = create_token(user.user_id)
     try:
         db.session.add(token)
@@ -940,6 +3231,93 @@ def web_register():
     return jsonify({"token": token.data})
 
 
+# generation takes tens of seconds, so it runs on a pool of its own rather
+# than holding a request worker
+WEB_NEWSLETTER_WORKERS = int(os.environ.get("RITUAL_WEB_NEWSLETTER_WORKERS", 4))
+# a request running for longer than this was lost with its worker
+NEWSLETTER_REQUEST_STALE = timedelta(seconds=NEWSLETTER_DEADLINE_SECONDS * 2)
+NEWSLETTER_REQUEST_RETENTION = timedelta(days=1)
+
+
+@functools.cache
+def get_web_newsletter_executor():
+    return ThreadPoolExecutor(
+        max_workers=WEB_NEWSLETTER_WORKERS, thread_name_prefix="ritual-web-newsletter"
+    )
+
+
+# true if this worker gets to run it, requests can be submitted more than once
+def claim_newsletter_request(request_id, now):
+    claimed = NewsletterRequest.query.filter(
+        NewsletterRequest.request_id == request_id,
+        sa.or_(
+            NewsletterRequest.status == "pending",
+            sa.and_(
+                NewsletterRequest.status == "running",
+                NewsletterRequest.started_at < now - NEWSLETTER_REQUEST_STALE,
+            ),
+        ),
+    ).update({"status": "running", "started_at": now}, synchronize_session=False)
+    db.session.commit()
+
+    return claimed == 1
+
+
+@profiled("run_newsletter_request")
+def run_newsletter_request(request_id):
+    with app.app_context():
+        if not claim_newsletter_request(request_id, datetime.now()):
+            return
+
+        newsletter_request = db.session.get(NewsletterRequest, request_id)
+        user = db.session.get(User, newsletter_request.user_id)
+        print(f"generating newsletter for {user.username}")
+
+        try:
+            job = newsletter_job(
+                user,
+                "web_newsletter",
+                None,
+                include_stored=False,
+                extra_entries=[tuple(e) for e in newsletter_request.entries],
+                packing_budget=NEWSLETTER_PACKING_BUDGET,
+                tree=True,
+            )
+
+            result = run_newsletter_jobs("web_newsletter", [job])[0]
+            if isinstance(result, Exception):
+                raise result
+
+            db.session.flush()
+            newsletter_request.newsletter_id = job.archived.newsletter_id
+            newsletter_request.html_tree = job.html_tree
+            newsletter_request.status = "done"
+            db.session.commit()
+        except Exception as e:
+            print(f"error generating newsletter for {user.username}: {e}")
+
+            db.session.rollback()
+            newsletter_request.status = "failed"
+            db.session.commit()
+
+
+def newsletter_request_response(newsletter_request):
+    return (
+        jsonify(
+            {
+                "job_id": newsletter_request.request_id,
+                "status": newsletter_request.status,
+            }
+        ),
+        202,
+        {
+            "Location": url_for(
+                "web_newsletter_status", request_id=newsletter_request.request_id
+            )
+        },
+    )
+
+
 @app.route("/web-newsletter", methods=["POST"])
 @token_auth
 def web_newsletter():
@@ -953,71 +3331,397 @@ def web_newsletter():
         print('rate limit reached for user "' + user.username + '"')
         return "Too Many Requests", 429
 
-    print(f"generating newsletter for {user.username}")
-    entries = request.json["entries"]
+    # one at a time, asking again while it runs returns the same job
+    in_flight = NewsletterRequest.query.filter(
+        NewsletterRequest.user_id == user.user_id,
+        NewsletterRequest.status.in_(("pending", "running")),
+    ).first()
+    if in_flight is not None:
+        return newsletter_request_response(in_flight)
+
+    newsletter_request = NewsletterRequest(
+        request_id=secrets.token_urlsafe(16),
+        user_id=user.user_id,
+        entries=[[e["createdDate"], e["content"]] for e in request.json["entries"]],
+    )
+    db.session.add(newsletter_request)
+    db.session.commit()
 
-    webpages = []
-    for e in entries:
-        webpages += get_exa_webpages(e["content"])
+    get_web_newsletter_executor().submit(
+        run_newsletter_request, newsletter_request.request_id
+    )
 
-    # dirty way to get rid of duplicate urls
-    webpages = {w["url"]: w for w in webpages}
+    return newsletter_request_response(newsletter_request)
 
-    formatted_string = ""
-    for e in entries:
-        entry_text = f"{e['createdDate']} -- {e['content']}\n\n"
-        if len(formatted_string + entry_text) < 7000:
-            formatted_string += entry_text
-        else:
-            break
 
-    formatted_string += "--- Webpages ---\n\n"
-    for w in webpages.values():
-        webpage_text = f"{w['title']} -- {w['url']}\n{w['text']}\n---\n"
-        if len(formatted_string + webpage_text) < 7000:
-            formatted_string += webpage_text
-        else:
-            break
+@app.route("/web-newsletter/<request_id>", methods=["GET"])
+@token_auth
+def web_newsletter_status(request_id):
+    newsletter_request = NewsletterRequest.query.filter_by(
+        request_id=request_id, user_id=request.user_id
+    ).first()
+    if newsletter_request is None:
+        return "Not Found", 404
+
+    if newsletter_request.status == "failed":
+        return "error", 400
+
+    if newsletter_request.status != "done":
+        return newsletter_request_response(newsletter_request)
+
+    newsletter = db.session.get(Newsletter, newsletter_request.newsletter_id)
+
+    return jsonify(
+        {
+            "status": "done",
+            "newsletter": newsletter.html,
+            "color": newsletter.color,
+            "jsonified_html": newsletter_request.html_tree,
+        }
+    )
+
+
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+
+
+# opaque to the client, the (creation_date, email_id) of the last entry returned
+def encode_history_cursor(email):
+    key = json.dumps([email.creation_date.isoformat(), email.email_id])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor):
+    created, email_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+
+    return datetime.fromisoformat(created), int(email_id)
+
+
+# a page of entries, newest first, strictly after `cursor` in that order
+# every page is one index range scan on (user_id, creation_date, email_id),
+# however deep it is
+def history_page(user_id, limit, cursor=None, since=None, until=None):
+    query = Email.query.filter(Email.user_id == user_id)
+    if since is not None:
+        query = query.filter(Email.creation_date >= since)
+    if until is not None:
+        query = query.filter(Email.creation_date < until)
+
+    if cursor is not None:
+        created, email_id = cursor
+        query = query.filter(
+            sa.or_(
+                Email.creation_date < created,
+                sa.and_(Email.creation_date == created, Email.email_id < email_id),
+            )
+        )
+
+    # one extra row says whether there's a next page
+    emails = (
+        query.order_by(Email.creation_date.desc(), Email.email_id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    next_cursor = encode_history_cursor(emails[limit - 1]) if len(emails) > limit else None
+
+    return emails[:limit], next_cursor
+
+
+#   GET /history?limit=20&since=2024-01-01&until=2024-02-01&cursor=<next_cursor>
+# `until` is exclusive
+@app.route("/history", methods=["GET"])
+@token_auth
+def get_history():
+    try:
+        limit = int(request.args.get("limit", HISTORY_DEFAULT_LIMIT))
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+        since = request.args.get("since")
+        since = datetime.fromisoformat(since) if since else None
+        until = request.args.get("until")
+        until = datetime.fromisoformat(until) if until else None
+
+        cursor = request.args.get("cursor")
+        cursor = decode_history_cursor(cursor) if cursor else None
+    except (ValueError, TypeError) as e:
+        print(f"bad history request: {e}")
+        return "error", 400
+
+    emails, next_cursor = history_page(request.user_id, limit, cursor, since, until)
+
+    return jsonify(
+        {
+            "entries": [
+                {
+                    "email_id": e.email_id,
+                    "created": e.creation_date.isoformat(),
+                    "imported": bool(e.imported_data),
+                    "text": get_db_email_text(e),
+                }
+                for e in emails
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
 
+
+# weekly mean similarity to each emotion, oldest week first
+@app.route("/mood-trend", methods=["GET"])
+@token_auth
+def get_mood_trend():
     try:
-        newsletter, color = get_newsletter(formatted_string)
-        html = jsonify_html(newsletter)
+        weeks = int(request.args.get("weeks", MOOD_TREND_DEFAULT_WEEKS))
+    except ValueError:
+        return "error", 400
+
+    weeks = max(1, min(weeks, MOOD_TREND_MAX_WEEKS))
+
+    return jsonify(
+        {
+            "emotions": Emotions.list_names(),
+            "weeks": mood_trend(request.user_id, weeks),
+        }
+    )
+
+
+# embeds entries that predate stored embeddings and folds them into the profile,
+# `--rebuild` then recomputes every user's weekly sums from the embeddings
+#   flask --app app backfill-emotions [--rebuild]
+@app.cli.command("backfill-emotions")
+@click.option("--rebuild", is_flag=True, help="Recompute weekly sums afterwards.")
+@profiled("backfill-emotions")
+def backfill_emotions(rebuild):
+    done = 0
+    while True:
+        emails = (
+            Email.query.outerjoin(
+                EmailEmbedding, EmailEmbedding.email_id == Email.email_id
+            )
+            .filter(EmailEmbedding.email_id.is_(None))
+            .order_by(Email.email_id)
+            .limit(EMOTION_BACKFILL_BATCH)
+            .all()
+        )
+        if len(emails) == 0:
+            break
+
+        texts = [get_db_email_text(e) for e in emails]
+
+        by_user = {}
+        with usage_scope(0, "backfill_emotions"):
+            for email, vectors in zip(emails, embed_chunks(texts)):
+                by_user.setdefault(email.user_id, ([], []))
+                by_user[email.user_id][0].append(email)
+                by_user[email.user_id][1].append(mean_vector(vectors))
+
+        for user_id, (user_emails, vectors) in by_user.items():
+            record_emotions(user_id, user_emails, vectors)
 
-        user.last_newsletter = datetime.now()
         db.session.commit()
 
-        return jsonify(
-            {"newsletter": newsletter, "color": color, "jsonified_html": html}
+        done += len(emails)
+        print(f"backfilled emotions for {done} entries")
+
+    if rebuild:
+        user_ids = [
+            user_id
+            for (user_id,) in db.session.query(EmailEmbedding.user_id).distinct()
+        ]
+        for user_id in user_ids:
+            weeks = rebuild_emotion_weeks(user_id)
+            db.session.commit()
+            print(f"rebuilt {weeks} weeks of emotions for user {user_id}")
+
+    flush_llm_usage()
+
+
+#   flask --app app import-entries someone@example.com journal.ndjson
+#   flask --app app import-entries someone@example.com export.mbox --format mbox
+@app.cli.command("import-entries")
+@click.argument("username")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "format_", type=click.Choice(["ndjson", "mbox"]))
+@profiled("import-entries")
+def import_entries_command(username, path, format_):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"no user '{username}'")
+
+    format_ = format_ or ("mbox" if path.endswith(".mbox") else "ndjson")
+    with open(path, "rb") as f:
+        if format_ == "mbox":
+            entries = iter_mbox_entries(f)
+        else:
+            entries = iter_ndjson_entries(
+                line.decode("utf-8", errors="replace") for line in f
+            )
+
+        progress = {}
+        for progress in import_entries(user.user_id, entries):
+            print(f"imported {progress['imported']} entries")
+
+    print(f"done: {progress['imported']} imported, {progress['skipped']} skipped")
+    for error in progress["errors"]:
+        print(f"  {error}")
+
+    flush_llm_usage()
+
+
+# brings an existing database up to the models: creates missing tables, adds
+# missing columns (filled with their default) and creates missing indexes
+#   flask --app app sync-schema
+@app.cli.command("sync-schema")
+def sync_schema():
+    inspector = sa.inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            print(f"creating table {table.name}")
+            table.create(db.engine)
+            continue
+
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+
+            print(f"adding column {table.name}.{column.name}")
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(
+                    sa.text(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"ADD COLUMN {quote(column.name)} {column_type} NULL"
+                    )
+                )
+                if column.default is not None and column.default.is_scalar:
+                    connection.execute(
+                        table.update().values({column.name: column.default.arg})
+                    )
+
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                print(f"creating index {index.name} on {table.name}")
+                index.create(db.engine)
+
+
+# a dedicated queue worker, run as many as needed on any number of nodes
+#   flask --app app work-newsletters --forever
+@app.cli.command("work-newsletters")
+@click.option("--max-tasks", type=int, default=None)
+@click.option("--forever", is_flag=True, help="Keep polling once the queue is empty.")
+@click.option("--poll", type=float, default=5.0, help="Seconds between polls.")
+@profiled("work-newsletters")
+def work_newsletters(max_tasks, forever, poll):
+    worked = 0
+    while max_tasks is None or worked < max_tasks:
+        worked += drain_newsletter_queue(
+            None if max_tasks is None else max_tasks - worked
         )
-    except Exception as e:
-        print(f"error generating/sending newsletter for {user.username}: {e}")
+        if not forever:
+            break
 
-        return "error", 400
+        sleep(poll)
+
+    counts = newsletter_queue().counts(db.session)
+    print(f"worked {worked} newsletter tasks, queue: {counts}")
+
+
+RAW_EMAIL_MIGRATION_BATCH = 500
+
+
+# moves a database from the old uncompressed `email.raw_email` column to
+# `raw_email_compressed` + `text`, safe to rerun and to run while serving
+#   flask --app app compress-emails
+@app.cli.command("compress-emails")
+@profiled("compress-emails")
+def compress_emails():
+    columns = {c["name"] for c in sa.inspect(db.engine).get_columns("email")}
+    if "raw_email" not in columns:
+        print("email.raw_email is already migrated")
+        return
+
+    mysql = db.engine.dialect.name == "mysql"
+    with db.engine.begin() as connection:
+        if "raw_email_compressed" not in columns:
+            blob = "MEDIUMBLOB" if mysql else "BLOB"
+            connection.execute(
+                sa.text(f"ALTER TABLE email ADD COLUMN raw_email_compressed {blob} NULL")
+            )
+        if "text" not in columns:
+            text_type = "MEDIUMTEXT" if mysql else "TEXT"
+            connection.execute(sa.text(f"ALTER TABLE email ADD COLUMN text {text_type} NULL"))
+        # rows written by the new code during the migration don't set it
+        if mysql:
+            connection.execute(sa.text("ALTER TABLE email MODIFY raw_email MEDIUMTEXT NULL"))
+
+    done = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                sa.text(
+                    "SELECT email_id, raw_email, imported_data FROM email "
+                    "WHERE raw_email_compressed IS NULL ORDER BY email_id LIMIT :limit"
+                ),
+                {"limit": RAW_EMAIL_MIGRATION_BATCH},
+            ).all()
+            if len(rows) == 0:
+                break
+
+            for email_id, raw, imported_data in rows:
+                compressed, text, digests = pack_raw_email(
+                    raw or "", bool(imported_data)
+                )
+                connection.execute(
+                    sa.text(
+                        "UPDATE email SET raw_email_compressed = :compressed, "
+                        "text = :text WHERE email_id = :email_id"
+                    ),
+                    {"compressed": compressed, "text": text, "email_id": email_id},
+                )
+                if len(digests) > 0:
+                    connection.execute(
+                        EmailBlob.__table__.insert(),
+                        [{"email_id": email_id, "digest": d} for d in digests],
+                    )
+
+        done += len(rows)
+        print(f"compressed {done} emails")
+
+    with db.engine.begin() as connection:
+        if mysql:
+            connection.execute(
+                sa.text("ALTER TABLE email MODIFY raw_email_compressed MEDIUMBLOB NOT NULL")
+            )
+        connection.execute(sa.text("ALTER TABLE email DROP COLUMN raw_email"))
+
+    print("dropped email.raw_email")
 
 
 @scheduler.task(
     "cron", id="send_test_newsletters", day_of_week="sat", hour=21, minute=15
 )
+@profiled("send_test_newsletters")
 def send_test_newsletters():
     end_date = datetime.now()
 
     with app.app_context():
         users = User.query.filter_by(test_user=True).all()
         print(f"sending test newsletters to {[u.username for u in users]}")
-        for user in users:
-            try:
-                emails = get_user_entries_in_range(user.user_id, 7)
-                formatted_email_text = format_emails_for_gpt(emails)
-                send_email(
-                    f'{{TESTING}} Ritual Weekly Report {end_date.strftime("%m/%d").lstrip("0").replace("/0", "/")}',
-                    get_newsletter(formatted_email_text)[0],
-                    user.username,
-                )
-            except Exception as e:
-                print(f"error generating newsletter for {user.username}: {e}")
+
+        subject = weekly_report_subject(end_date, prefix="{TESTING} ")
+        generate_newsletter_batch(
+            users,
+            "send_test_newsletters",
+            {user.user_id: subject for user in users},
+        )
 
 
 @scheduler.task("cron", id="user_last_active_check", hour=18, minute=0)
+@profiled("user_last_active_check")
 def user_last_active_check():
     print("running `user_last_active_check`")
     limit = datetime.now() - timedelta(days=4)
@@ -1031,79 +3735,150 @@ def user_last_active_check():
     print(f"end `user_last_active_check` -- updated {len(users)} users")
 
 
-# this should really be abstracted to a separate function
-# p much a complete copy+paste from `send_newsletters`
-#
-# "cleanup"/followup function for users that are also using the CLI
-# in case their cron job fails
+# queues newsletters over the hours before each user's send time, so the user
+# base isn't generated in one spike; `work_newsletter_queue` generates them
 @scheduler.task(
-    "cron", id="send_remaining_newsletters", day_of_week="sun", hour=13, minute=30
+    "interval", id="prepare_newsletters", minutes=10, misfire_grace_time=600
 )
-def send_remaining_newsletters():
+@profiled("prepare_newsletters")
+def prepare_newsletters():
     with app.app_context():
-        end_date = datetime.now()
+        try:
+            prepare_newsletter_batch(utc_now())
+        except Exception as e:
+            db.session.rollback()
+            print(f"error preparing newsletters: {e}")
 
-        yesterday = datetime.now() - timedelta(days=1)
-        # if the user hasn't received a newsletter yet today
-        users = User.query.filter(
-            User.active == True, User.last_newsletter < yesterday
-        ).all()
-        print(f"sending remaining newsletters to {[u.username for u in users]}")
 
-        successes = []
-        for user in users:
-            try:
-                emails = get_user_entries_in_range(user.user_id, 7)
-                formatted_email_text = format_emails_for_gpt(emails)
-                if len(emails) > 0:
-                    memory_embedding = get_embedding(formatted_email_text)
-
-                    memory_ids = [
-                        x["metadata"]["email_id"]
-                        for x in memory_index.query(
-                            vector=memory_embedding,
-                            top_k=3,
-                            include_metadata=True,
-                            filter={
-                                "user_id": {"$eq": emails[0].user_id},
-                                "email_id": {"$nin": [e.email_id for e in emails]},
-                            },
-                        )["matches"]
-                    ]
-
-                    memories = Email.query.filter(Email.email_id.in_(memory_ids)).all()
-
-                    formatted_email_text += "--- Memories ---\n\n"
-                    for m in memories:
-                        formatted_email_text += get_db_email_text(m) + "\n---\n"
-
-                send_email(
-                    f'Ritual Weekly Report {end_date.strftime("%m/%d").lstrip("0").replace("/0", "/")}',
-                    get_newsletter(formatted_email_text)[0],
-                    user.username,
-                )
+# sends each prepared newsletter at the user's local delivery time
+@scheduler.task("interval", id="release_newsletters", seconds=60, misfire_grace_time=60)
+@profiled("release_newsletters")
+def release_newsletters():
+    with app.app_context():
+        released = release_newsletter_batch(utc_now())
+        if released > 0:
+            print(f"released {released} newsletters")
 
-                user.last_newsletter = datetime.now()
 
-                if not user.archiving:
-                    successes += emails
-            except Exception as e:
-                print(f"error generating newsletter for {user.username}: {e}")
+# runs requests lost with the worker that took them, and drops old ones
+@scheduler.task(
+    "interval", id="resume_newsletter_requests", seconds=60, misfire_grace_time=60
+)
+@profiled("resume_newsletter_requests")
+def resume_newsletter_requests():
+    now = datetime.now()
+    with app.app_context():
+        NewsletterRequest.query.filter(
+            NewsletterRequest.creation_date < now - NEWSLETTER_REQUEST_RETENTION
+        ).delete()
+        db.session.commit()
 
-        try:
-            for email in successes:
-                db.session.delete(email)
+        lost = db.session.query(NewsletterRequest.request_id).filter(
+            sa.or_(
+                sa.and_(
+                    NewsletterRequest.status == "pending",
+                    NewsletterRequest.creation_date < now - timedelta(minutes=1),
+                ),
+                sa.and_(
+                    NewsletterRequest.status == "running",
+                    NewsletterRequest.started_at < now - NEWSLETTER_REQUEST_STALE,
+                ),
+            )
+        )
+        for (request_id,) in lost.all():
+            print(f"resuming newsletter request {request_id}")
+            get_web_newsletter_executor().submit(run_newsletter_request, request_id)
 
-            db.session.commit()
+
+# every node running the scheduler helps drain the newsletter queue, and picks
+# up tasks whose worker died once their lease runs out
+@scheduler.task(
+    "interval",
+    id="work_newsletter_queue",
+    seconds=30,
+    max_instances=1,
+    misfire_grace_time=30,
+)
+@profiled("work_newsletter_queue")
+def work_newsletter_queue():
+    with app.app_context():
+        try:
+            worked = drain_newsletter_queue()
         except Exception as e:
-            print(
-                f"error deleting email id {email.email_id} for user id {email.user_id}: {e}"
+            db.session.rollback()
+            print(f"error working the newsletter queue: {e}")
+            return
+
+        if worked > 0:
+            print(f"worked {worked} newsletter tasks")
+
+
+@scheduler.task(
+    "interval", id="clean_newsletter_tasks", hours=1, misfire_grace_time=3600
+)
+@profiled("clean_newsletter_tasks")
+def clean_newsletter_tasks():
+    with app.app_context():
+        deleted = NewsletterTask.query.filter(
+            NewsletterTask.status.notin_((PENDING, LEASED)),
+            NewsletterTask.creation_date < datetime.now() - NEWSLETTER_TASK_RETENTION,
+        ).delete()
+        db.session.commit()
+
+    print(f"end `clean_newsletter_tasks` -- deleted {deleted} tasks")
+
+
+# deletes the blobs emails stopped referencing at least `BLOB_GRACE` ago
+@scheduler.task("interval", id="clean_blobs", minutes=10, misfire_grace_time=600)
+@profiled("clean_blobs")
+def clean_blobs():
+    deleted = 0
+    with app.app_context():
+        orphans = [
+            digest
+            for (digest,) in db.session.query(OrphanBlob.digest).filter(
+                OrphanBlob.released_at < datetime.now() - BLOB_GRACE
             )
+        ]
 
-        return "success", 200
+        for i in range(0, len(orphans), 1000):
+            chunk = orphans[i : i + 1000]
+            referenced = {
+                digest
+                for (digest,) in db.session.query(EmailBlob.digest).filter(
+                    EmailBlob.digest.in_(chunk)
+                )
+            }
+
+            done = []
+            for digest in chunk:
+                if digest in referenced:
+                    done.append(digest)
+                    continue
+
+                try:
+                    removed = blob_store().delete(digest, BLOB_GRACE.total_seconds())
+                except OSError as e:
+                    print(f"error deleting blob {digest}: {e}")
+                    continue
+
+                # stored again since its release, by an email not committed yet
+                if not removed and blob_store().exists(digest):
+                    continue
+
+                deleted += removed
+                done.append(digest)
+
+            OrphanBlob.query.filter(OrphanBlob.digest.in_(done)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+
+    print(f"end `clean_blobs` -- deleted {deleted} blobs")
 
 
 @scheduler.task("interval", id="clean_tokens", seconds=900, misfire_grace_time=900)
+@profiled("clean_tokens")
 def clean_tokens():
     print("running `clean_tokens`")
     limit = datetime.now() - timedelta(minutes=30)
@@ -1117,10 +3892,55 @@ def clean_tokens():
     print(f"end `clean_tokens` -- updated {len(tokens)} users")
 
 
+@scheduler.task("interval", id="clean_rate_limits", hours=1, misfire_grace_time=3600)
+@profiled("clean_rate_limits")
+def clean_rate_limits():
+    if RATE_LIMIT_BACKEND != "db":
+        return
+
+    with app.app_context():
+        print(f"`clean_rate_limits` -- removed {rate_limit_backend().prune()} buckets")
+
+
+@scheduler.task(
+    "interval",
+    id="flush_llm_usage",
+    seconds=LLM_USAGE_FLUSH_SECONDS,
+    misfire_grace_time=LLM_USAGE_FLUSH_SECONDS,
+)
+@profiled("flush_llm_usage")
+def flush_llm_usage():
+    global _pending_usage
+
+    with _pending_usage_lock:
+        rows, _pending_usage = _pending_usage, {}
+
+    if len(rows) == 0:
+        return
+
+    with app.app_context():
+        try:
+            upsert_usage(rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"error flushing llm usage, requeueing {len(rows)} rows: {e}")
+
+            with _pending_usage_lock:
+                for key, (count, prompt, completion) in rows.items():
+                    totals = _pending_usage.setdefault(key, [0, 0, 0])
+                    totals[0] += count
+                    totals[1] += prompt
+                    totals[2] += completion
+
+
+atexit.register(flush_llm_usage)
+
+
 @app.route("/")
 def serve():
     return send_from_directory(app.static_folder, "index.html")
 
 
 if __name__ == "__main__":
-    app.run(use_reloader=True, port=5000)
+    create_app().run(use_reloader=True, port=5000)
@@ -0,0 +1,117 @@
+# seeded sqlite dataset of synthetic users and journal emails
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from bench.fakes import fake_embedding
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EMAIL_API_KEY = "bench-email-api-key"
+WEB_PASSWORD = "bench-password"
+
+WORDS = (
+    "ran gym read wrote cooked slept meditated called family worked shipped "
+    "walked studied practiced guitar journaled planned cleaned stretched "
+    "focused procrastinated rested tired energized grateful anxious calm"
+).split()
+
+
+def bench_username(i):
+    return f"bench-user-{i}@example.com"
+
+
+def bench_token(i):
+    return f"bench-token-{i}"
+
+
+def fake_entry_text(rng, sentences=4):
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize()
+        + "."
+        for _ in range(sentences)
+    )
+
+
+def fake_raw_email(sender, text):
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = "ritual@joeytan.dev"
+    message["Subject"] = "log"
+    message.set_content(text)
+    message.add_alternative(f"<html><body><p>{text}</p></body></html>", subtype="html")
+
+    return message.as_string()
+
+
+# points `app` at a throwaway sqlite db and configures it
+def load_app(db_path=None):
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="ritual-bench-"), "bench.db")
+
+    os.environ["RITUAL_DB_URL"] = f"sqlite:///{db_path}"
+    os.environ["RITUAL_EMAIL_API_KEY"] = EMAIL_API_KEY
+    os.environ["EXAI_API_KEY"] = "bench-exa-key"
+    # each run starts with a cold Exa cache next to its database
+    os.environ["RITUAL_EXA_CACHE_PATH"] = os.path.join(
+        os.path.dirname(db_path), "exa.sqlite3"
+    )
+    os.environ["RITUAL_BLOB_PATH"] = os.path.join(os.path.dirname(db_path), "blobs")
+
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    import app
+
+    app.create_app(start_scheduler=False)
+
+    return app
+
+
+# recreates the schema and fills it with `users` users holding
+# `entries` emails each, spread over the past week
+# `password_hash` is stored as every user's web login secret
+def seed(app_module, users, entries, seed=0, memory_index=None, password_hash="bench"):
+    rng = random.Random(seed)
+    db = app_module.db
+    now = datetime.now()
+
+    with app_module.app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        for i in range(users):
+            user = app_module.User(
+                username=bench_username(i),
+                password="bench",
+                active=True,
+                archiving=True,
+                web_secret=password_hash,
+                last_newsletter=now - timedelta(days=8),
+            )
+            db.session.add(user)
+            db.session.flush()
+
+            db.session.add(app_module.Token(user_id=user.user_id, data=bench_token(i)))
+
+            for j in range(entries):
+                text = fake_entry_text(rng)
+                email = app_module.Email(
+                    user_id=user.user_id,
+                    raw_email=fake_raw_email(user.username, text),
+                    creation_date=now - timedelta(minutes=rng.randint(0, 7 * 24 * 60)),
+                    imported_data=False,
+                )
+                db.session.add(email)
+
+                if memory_index is not None:
+                    db.session.flush()
+                    memory_index.vectors[f"email-{email.email_id}"] = (
+                        fake_embedding(text),
+                        {"user_id": user.user_id, "email_id": email.email_id},
+                    )
+
+        db.session.commit()
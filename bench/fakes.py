@@ -0,0 +1,333 @@
+# deterministic local stand-ins for OpenAI, Pinecone, Exa and SES
+#
+# every fake shares a `FakeService` that injects latency and errors from a
+# seeded rng, so two runs with the same settings see the same failures
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+EMBEDDING_DIMENSIONS = 256
+
+
+# a ConnectionError, so the app treats injected failures as transient
+class FakeServiceError(ConnectionError):
+    pass
+
+
+class FakeService:
+    def __init__(self, name, latency_ms=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+
+        self._rng = random.Random(f"{name}:{seed}")
+        self._lock = threading.Lock()
+
+    # returns (seconds to wait, whether this call should fail)
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            spread = self._rng.uniform(-self.jitter, self.jitter)
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        return max(0.0, self.latency_ms * (1 + spread)) / 1000, failed
+
+    # sleeps for the configured latency, returns True if this call should fail
+    def simulate(self):
+        delay, failed = self._draw()
+        if delay > 0:
+            time.sleep(delay)
+
+        return failed
+
+    async def simulate_async(self):
+        delay, failed = self._draw()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        return failed
+
+    def check(self):
+        if self.simulate():
+            raise FakeServiceError(f"injected {self.name} failure")
+
+    async def check_async(self):
+        if await self.simulate_async():
+            raise FakeServiceError(f"injected {self.name} failure")
+
+
+# unit vector derived from the text's hash, identical text -> identical vector
+def fake_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+
+    return [x / norm for x in vector]
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+FAKE_NEWSLETTER = """## Your Week
+
+You kept showing up this week, and that consistency is worth noticing.
+
+### Looking Ahead
+
+Keep the mornings protected. Take a look at https://example.com/routines for ideas.
+"""
+
+
+class FakeOpenAI:
+    def __init__(self, service):
+        self.service = service
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def _chat(self, model, messages, temperature=None, **kwargs):
+        self.service.check()
+
+        return self._chat_response(model, messages)
+
+    def _chat_response(self, model, messages):
+        system_prompt = messages[0]["content"]
+        user_prompt = messages[-1]["content"]
+        content = "#C8B8A6" if "hex color" in system_prompt else FAKE_NEWSLETTER
+
+        prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+        completion_tokens = estimate_tokens(content)
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+            model=model,
+            prompt=user_prompt,
+        )
+
+    def _embed(self, input, model, **kwargs):
+        self.service.check()
+
+        return self._embed_response(input, model)
+
+    def _embed_response(self, input, model):
+        texts = [input] if isinstance(input, str) else list(input)
+        tokens = sum(estimate_tokens(t) for t in texts)
+
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(index=i, embedding=fake_embedding(t))
+                for i, t in enumerate(texts)
+            ],
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens),
+            model=model,
+        )
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    def __init__(self, service):
+        super().__init__(service)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_async))
+        self.embeddings = SimpleNamespace(create=self._embed_async)
+
+    async def _chat_async(self, model, messages, temperature=None, **kwargs):
+        await self.service.check_async()
+
+        return self._chat_response(model, messages)
+
+    async def _embed_async(self, input, model, **kwargs):
+        await self.service.check_async()
+
+        return self._embed_response(input, model)
+
+
+def _matches_filter(metadata, filter):
+    for key, condition in (filter or {}).items():
+        value = metadata.get(key)
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+            if op == "$nin" and value in expected:
+                return False
+
+    return True
+
+
+# brute force in-memory index that answers like pinecone's dict responses
+class FakeIndex:
+    def __init__(self, service):
+        self.service = service
+        self.vectors = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors, **kwargs):
+        self.service.check()
+
+        with self._lock:
+            for v in vectors:
+                self.vectors[v["id"]] = (v["values"], v.get("metadata", {}))
+
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector, top_k=10, include_metadata=False, filter=None, **kwargs):
+        self.service.check()
+
+        with self._lock:
+            candidates = list(self.vectors.items())
+
+        scored = []
+        for vector_id, (values, metadata) in candidates:
+            if not _matches_filter(metadata, filter):
+                continue
+
+            score = sum(a * b for a, b in zip(vector, values))
+            scored.append((score, vector_id, metadata))
+
+        scored.sort(key=lambda x: x[0], reverse=True)
+
+        return {
+            "matches": [
+                {
+                    "id": vector_id,
+                    "score": score,
+                    "metadata": metadata if include_metadata else None,
+                }
+                for score, vector_id, metadata in scored[:top_k]
+            ]
+        }
+
+
+class FakeSes:
+    def __init__(self, service):
+        self.service = service
+        self.sent = 0
+
+    def send_email(self, **kwargs):
+        self.service.check()
+        self.sent += 1
+
+        return {"MessageId": f"fake-{self.sent}"}
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+# stands in for the shared `httpx.AsyncClient` of the async pipeline
+class FakeExa:
+    def __init__(self, service, results_per_search=30):
+        self.service = service
+        self.results_per_search = results_per_search
+
+    async def post(self, url, headers=None, json=None, **kwargs):
+        if await self.service.simulate_async():
+            return FakeResponse(500, {"error": "injected exa failure"})
+
+        return self._response(url, json)
+
+    def _response(self, url, json):
+        if url.endswith("/search"):
+            rng = random.Random(json["query"])
+            return FakeResponse(
+                200,
+                {
+                    "results": [
+                        {
+                            "id": f"page-{rng.randrange(10_000)}",
+                            "score": rng.random(),
+                            "url": f"https://example.com/{i}",
+                            "title": f"Example page {i}",
+                        }
+                        for i in range(self.results_per_search)
+                    ]
+                },
+            )
+
+        return FakeResponse(
+            200,
+            {
+                "results": [
+                    {
+                        "id": page_id,
+                        "url": f"https://example.com/{page_id}",
+                        "title": f"Page {page_id}",
+                        "text": f"Some personal site content for {page_id}. " * 8,
+                    }
+                    for page_id in json["ids"]
+                ]
+            },
+        )
+
+
+class FakeBackends:
+    def __init__(self, latency_ms=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        def service(name):
+            return FakeService(name, latency_ms, jitter, error_rate, seed)
+
+        self.openai = FakeOpenAI(service("openai"))
+        self.async_openai = FakeAsyncOpenAI(self.openai.service)
+        self.pinecone = service("pinecone")
+        self.pc_index = FakeIndex(self.pinecone)
+        self.memory_index = FakeIndex(self.pinecone)
+        self.ses = FakeSes(service("ses"))
+        self.exa = FakeExa(service("exa"))
+
+        self._seed_quotes(seed)
+
+    def _seed_quotes(self, seed):
+        rng = random.Random(seed)
+        for i in range(200):
+            text = f"Quote number {i}: " + " ".join(
+                rng.choice(["habit", "growth", "time", "patience", "focus", "rest"])
+                for _ in range(40)
+            )
+            self.pc_index.vectors[f"quote-{i}"] = (
+                fake_embedding(text),
+                {"text": text, "author": f"Author {i % 17}", "title": f"Book {i % 23}"},
+            )
+
+    def services(self):
+        return [
+            self.openai.service,
+            self.pinecone,
+            self.ses.service,
+            self.exa.service,
+        ]
+
+    def stats(self):
+        return {
+            s.name: {"calls": s.calls, "errors": s.errors} for s in self.services()
+        }
+
+    # swaps the clients `app` hands out for these fakes
+    def install(self, app_module):
+        app_module.register_client("openai", self.openai)
+        app_module.register_client("ses", self.ses)
+        app_module.register_client("pc_index", self.pc_index)
+        app_module.register_client("memory_index", self.memory_index)
+        app_module.register_client("async_openai", self.async_openai)
+        app_module.register_client("async_http", self.exa)
@@ -0,0 +1,357 @@
+# HTTP load tests for the flask endpoints under gunicorn
+#
+#   python -m bench.loadtest --scenario mixed --workers 4 --concurrency 1,8,32,64
+#
+# seeds a sqlite database, starts gunicorn on `bench.stub_app` (fake OpenAI,
+# Pinecone, Exa and SES), then drives a weighted request mix at each
+# concurrency level and records latency, errors and worker saturation
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import bcrypt
+import requests
+
+from bench import dataset
+from bench.pipeline import RESULTS_DIR, git_revision, percentile
+
+# relative weights of each endpoint per scenario
+SCENARIOS = {
+    "mixed": {
+        "user_lookup": 30,
+        "web_login": 15,
+        "update_settings": 10,
+        "email_log_activities": 35,
+        "web_newsletter": 10,
+    },
+    "sunday_morning": {
+        "user_lookup": 20,
+        "web_login": 40,
+        "update_settings": 5,
+        "email_log_activities": 10,
+        "web_newsletter": 25,
+    },
+    "ingest": {"email_log_activities": 100},
+    "auth": {"user_lookup": 40, "web_login": 60},
+    "newsletter": {"web_newsletter": 100},
+}
+
+
+def build_request(endpoint, rng, users):
+    i = rng.randrange(users)
+    username = dataset.bench_username(i)
+    bearer = {"Authorization": f"Bearer {dataset.bench_token(i)}"}
+
+    if endpoint == "user_lookup":
+        return "GET", "/user-lookup", {"params": {"username": username}}
+
+    if endpoint == "web_login":
+        return (
+            "POST",
+            "/web-login",
+            {"json": {"email": username, "password": dataset.WEB_PASSWORD}},
+        )
+
+    if endpoint == "update_settings":
+        return (
+            "POST",
+            "/update-settings",
+            {
+                "headers": bearer,
+                "json": {
+                    "delete_user": False,
+                    "receiving_logs": rng.random() < 0.5,
+                    "receiving_newsletters": True,
+                    "deleting_data": False,
+                },
+            },
+        )
+
+    if endpoint == "email_log_activities":
+        return (
+            "POST",
+            "/email-log-activities",
+            {
+                "headers": {"Authorization": f"Bearer {dataset.EMAIL_API_KEY}"},
+                "json": {
+                    "username": username,
+                    "email_data": dataset.fake_raw_email(
+                        username, dataset.fake_entry_text(rng)
+                    ),
+                },
+            },
+        )
+
+    if endpoint == "web_newsletter":
+        return (
+            "POST",
+            "/web-newsletter",
+            {
+                "headers": bearer,
+                "json": {
+                    "entries": [
+                        {
+                            "createdDate": str(datetime.now().date()),
+                            "content": dataset.fake_entry_text(rng),
+                        }
+                        for _ in range(5)
+                    ]
+                },
+            },
+        )
+
+    raise ValueError(f"unknown endpoint {endpoint}")
+
+
+class Sample:
+    __slots__ = ("endpoint", "latency", "status", "worker", "in_flight", "service")
+
+    def __init__(self, endpoint, latency, status, worker, in_flight, service):
+        self.endpoint = endpoint
+        self.latency = latency
+        self.status = status
+        self.worker = worker
+        self.in_flight = in_flight
+        self.service = service
+
+
+def run_level(base_url, mix, users, concurrency, duration, seed, timeout):
+    endpoints = list(mix.keys())
+    weights = list(mix.values())
+    samples = []
+    samples_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(n):
+        rng = random.Random(f"{seed}:{concurrency}:{n}")
+        session = requests.Session()
+        local = []
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(endpoints, weights)[0]
+            method, path, kwargs = build_request(endpoint, rng, users)
+
+            begin = time.perf_counter()
+            try:
+                response = session.request(
+                    method, base_url + path, timeout=timeout, **kwargs
+                )
+                latency = time.perf_counter() - begin
+                local.append(
+                    Sample(
+                        endpoint,
+                        latency,
+                        response.status_code,
+                        response.headers.get("X-Bench-Worker"),
+                        int(response.headers.get("X-Bench-In-Flight", 0)),
+                        float(response.headers.get("X-Bench-Service-Ms", 0)) / 1000,
+                    )
+                )
+            except requests.RequestException:
+                local.append(
+                    Sample(endpoint, time.perf_counter() - begin, 0, None, 0, 0.0)
+                )
+
+        with samples_lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return samples, time.perf_counter() - started
+
+
+def summarize_samples(samples, elapsed):
+    def stats(group):
+        latencies = [s.latency for s in group]
+        # time spent waiting for a free worker rather than inside the app
+        queueing = [max(0.0, s.latency - s.service) for s in group if s.worker]
+        errors = [s for s in group if s.status == 0 or s.status >= 500]
+        rejected = [s for s in group if 400 <= s.status < 500]
+
+        return {
+            "requests": len(group),
+            "rps": len(group) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "queue_p95_ms": percentile(queueing, 95) * 1000,
+            "error_rate": len(errors) / len(group) if group else 0.0,
+            "rejected_rate": len(rejected) / len(group) if group else 0.0,
+            "statuses": {
+                str(code): sum(1 for s in group if s.status == code)
+                for code in sorted({s.status for s in group})
+            },
+        }
+
+    by_endpoint = defaultdict(list)
+    by_worker = defaultdict(list)
+    for s in samples:
+        by_endpoint[s.endpoint].append(s)
+        if s.worker:
+            by_worker[s.worker].append(s)
+
+    return {
+        "overall": stats(samples),
+        "endpoints": {name: stats(group) for name, group in sorted(by_endpoint.items())},
+        "workers": {
+            pid: {
+                "requests": len(group),
+                # fraction of wall time the worker spent serving requests
+                "busy": min(1.0, sum(s.service for s in group) / elapsed),
+                "max_in_flight": max(s.in_flight for s in group),
+            }
+            for pid, group in sorted(by_worker.items())
+        },
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, db_path, port):
+    env = os.environ.copy() | {
+        "RITUAL_BENCH_DB": db_path,
+        "RITUAL_BENCH_LATENCY_MS": str(args.latency),
+        "RITUAL_BENCH_ERROR_RATE": str(args.error_rate),
+        "RITUAL_BENCH_SEED": str(args.seed),
+        "RITUAL_RATE_LIMIT_BACKEND": args.rate_limit,
+    }
+
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "--workers",
+        str(args.workers),
+        "--worker-class",
+        args.worker_class,
+        "--threads",
+        str(args.threads),
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--log-level",
+        "warning",
+        "bench.stub_app:app",
+    ]
+
+    log = open(os.path.join(os.path.dirname(db_path), "gunicorn.log"), "w")
+    server = subprocess.Popen(
+        command, cwd=dataset.ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited, see {log.name}")
+
+        try:
+            requests.get(url + "/user-lookup", params={"username": "x"}, timeout=1)
+            return server, url
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def parse_counts(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--concurrency", type=parse_counts, default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per level")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--worker-class", default="sync")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="ms per fake call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    # every simulated client shares one ip, so limits are off unless asked for
+    parser.add_argument("--rate-limit", choices=["off", "memory", "db"], default="off")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="ritual-load-"), "bench.db")
+    app_module = dataset.load_app(db_path)
+    password_hash = bcrypt.hashpw(dataset.WEB_PASSWORD.encode("utf-8"), bcrypt.gensalt())
+    dataset.seed(
+        app_module, args.users, args.entries, args.seed, password_hash=password_hash.decode()
+    )
+
+    server, url = start_server(args, db_path, free_port())
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "mix": SCENARIOS[args.scenario],
+        "levels": {},
+    }
+
+    try:
+        for concurrency in args.concurrency:
+            samples, elapsed = run_level(
+                url,
+                SCENARIOS[args.scenario],
+                args.users,
+                concurrency,
+                args.duration,
+                args.seed,
+                args.timeout,
+            )
+            summary = summarize_samples(samples, elapsed)
+            report["levels"][str(concurrency)] = summary
+
+            overall = summary["overall"]
+            busy = [w["busy"] for w in summary["workers"].values()]
+            print(
+                f"concurrency {concurrency:>4}: {overall['rps']:8.1f} req/s  "
+                f"p50 {overall['p50_ms']:8.1f}ms  p95 {overall['p95_ms']:8.1f}ms  "
+                f"p99 {overall['p99_ms']:8.1f}ms  queue p95 {overall['queue_p95_ms']:8.1f}ms  "
+                f"errors {overall['error_rate']:.2%}  "
+                f"worker busy {(sum(busy) / len(busy)) if busy else 0:.0%}"
+            )
+            for name, endpoint in summary["endpoints"].items():
+                print(
+                    f"    {name:<22} {endpoint['rps']:8.1f} req/s  p95 {endpoint['p95_ms']:8.1f}ms  "
+                    f"errors {endpoint['error_rate']:.2%}  statuses {endpoint['statuses']}"
+                )
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"loadtest-{args.scenario}-{report['revision']}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
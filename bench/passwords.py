@@ -0,0 +1,137 @@
+# login throughput with bcrypt on the request threads vs on the process pool
+#
+#   python -m bench.passwords --rounds 12 --threads 8 --workers 0,1,2
+#
+# drives /web-login from `threads` client threads through the flask test
+# client, once per pool size (0 = hashing on the request thread), while one
+# more thread keeps calling /user-lookup to show what a burst of logins does
+# to every other request
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import bcrypt
+
+from bench import dataset
+from bench.pipeline import RESULTS_DIR, git_revision, parse_counts, percentile
+
+
+def run(app_module, users, threads, duration):
+    logins = []
+    lookups = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def login(n):
+        client = app_module.app.test_client()
+        local = []
+        i = n
+        while time.perf_counter() < deadline:
+            begin = time.perf_counter()
+            response = client.post(
+                "/web-login",
+                json={
+                    "email": dataset.bench_username(i % users),
+                    "password": dataset.WEB_PASSWORD,
+                },
+            )
+            local.append((time.perf_counter() - begin, response.status_code))
+            i += threads
+
+        with lock:
+            logins.extend(latency for latency, _ in local)
+            for _, status in local:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    def lookup():
+        client = app_module.app.test_client()
+        while time.perf_counter() < deadline:
+            begin = time.perf_counter()
+            client.get("/user-lookup", query_string={"username": dataset.bench_username(0)})
+            lookups.append(time.perf_counter() - begin)
+            time.sleep(0.01)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=login, args=(n,)) for n in range(threads)]
+    workers.append(threading.Thread(target=lookup))
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "logins": statuses.get(200, 0),
+        "statuses": statuses,
+        "throughput": statuses.get(200, 0) / elapsed,
+        "login_p50_ms": percentile(logins, 50) * 1000,
+        "login_p95_ms": percentile(logins, 95) * 1000,
+        "lookup_p50_ms": percentile(lookups, 50) * 1000,
+        "lookup_p95_ms": percentile(lookups, 95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--workers", type=parse_counts, default=[0, 1, 2])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    # every simulated client shares one ip
+    os.environ["RITUAL_RATE_LIMIT_BACKEND"] = "off"
+    app_module = dataset.load_app()
+
+    password_hash = bcrypt.hashpw(
+        dataset.WEB_PASSWORD.encode("utf-8"), bcrypt.gensalt(args.rounds)
+    )
+    dataset.seed(app_module, args.users, 0, password_hash=password_hash.decode())
+
+    cores = os.cpu_count() or 1
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args) | {"cores": cores},
+        "results": {},
+    }
+
+    for workers in args.workers:
+        hasher = app_module.PasswordHasher(args.rounds, workers)
+        app_module.password_hasher = hasher
+        # the pool's processes start outside the measured run
+        hasher.hash(dataset.WEB_PASSWORD)
+
+        result = run(app_module, args.users, args.threads, args.duration)
+        hasher.shutdown()
+
+        # the cores hashing may use, all of them on the request threads
+        result["per_core"] = result["throughput"] / (min(workers, cores) or cores)
+        report["results"][f"workers={workers}"] = result
+
+        print(
+            f"workers={workers:<3} {result['throughput']:7.2f} logins/s  "
+            f"{result['per_core']:7.2f}/s per core  "
+            f"login p50 {result['login_p50_ms']:8.1f}ms p95 {result['login_p95_ms']:8.1f}ms  "
+            f"lookup p50 {result['lookup_p50_ms']:7.1f}ms p95 {result['lookup_p95_ms']:7.1f}ms  "
+            f"statuses {result['statuses']}"
+        )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"passwords-{report['revision']}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# offline benchmarks for the ingest and newsletter pipelines
+#
+#   python -m bench.pipeline --users 1,10 --entries 5,25 --latency 20
+#   python -m bench.pipeline --compare bench/results/<previous>.json
+#
+# every external service is replaced by `bench.fakes`, so results measure our
+# own overhead plus whatever latency is injected
+import argparse
+import json
+import os
+import subprocess
+import time
+from datetime import datetime, timedelta
+
+from bench import dataset
+from bench.fakes import FakeBackends
+
+SCENARIOS = (
+    "email_log_activities",
+    "send_newsletters",
+    "prepare_and_release_newsletters",
+    "web_newsletter",
+    "generate_newsletter",
+)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(samples, p):
+    if len(samples) == 0:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "runs": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": (sum(latencies) / len(latencies) * 1000) if latencies else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return "unknown"
+
+
+class PipelineBench:
+    def __init__(self, app_module, backends):
+        self.app = app_module
+        self.backends = backends
+        self.client = app_module.app.test_client()
+
+    def _reset_newsletter_dates(self):
+        app = self.app
+        with app.app.app_context():
+            app.User.query.update(
+                {app.User.last_newsletter: datetime.now() - timedelta(days=8)}
+            )
+            app.db.session.commit()
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            raise RuntimeError(f"{response.status_code}: {response.get_data(True)}")
+
+    def email_log_activities(self, i, rng_text):
+        response = self.client.post(
+            "/email-log-activities",
+            headers={"Authorization": f"Bearer {dataset.EMAIL_API_KEY}"},
+            json={
+                "username": dataset.bench_username(0),
+                "email_data": dataset.fake_raw_email(
+                    dataset.bench_username(0), rng_text
+                ),
+            },
+        )
+        self._check(response)
+
+    def send_newsletters(self, i, rng_text):
+        response = self.client.post(
+            "/send-newsletters",
+            headers={"Authorization": f"Bearer {dataset.EMAIL_API_KEY}"},
+            json={"username": dataset.bench_username(0)},
+        )
+        self._check(response)
+
+    # runs at the seeded users' (shared) send time, so every one of them is
+    # generated and released in one go
+    def prepare_and_release_newsletters(self, i, rng_text):
+        app = self.app
+        with app.app.app_context():
+            app.User.query.update({app.User.last_newsletter: datetime(2000, 1, 1)})
+            app.Newsletter.query.filter(app.Newsletter.sent_at.is_(None)).delete()
+            # a send time is only queued once
+            app.NewsletterTask.query.delete()
+            app.db.session.commit()
+
+            now = app.scheduled_send_time(app.User.query.first(), app.utc_now())
+            if app.prepare_newsletter_batch(now, limit=None) == 0:
+                raise RuntimeError("no newsletters prepared")
+            app.drain_newsletter_queue()
+            app.release_newsletter_batch(now, limit=None)
+
+    # enqueues the generation and polls until it's done
+    def web_newsletter(self, i, rng_text):
+        self._reset_newsletter_dates()
+        headers = {"Authorization": f"Bearer {dataset.bench_token(0)}"}
+        response = self.client.post(
+            "/web-newsletter",
+            headers=headers,
+            json={
+                "entries": [
+                    {"createdDate": str(datetime.now().date()), "content": rng_text}
+                    for _ in range(5)
+                ]
+            },
+        )
+        self._check(response)
+
+        while response.status_code == 202:
+            time.sleep(0.005)
+            response = self.client.get(response.headers["Location"], headers=headers)
+            self._check(response)
+
+    # the stages every newsletter goes through, without exa, memories or archiving
+    def generate_newsletter(self, i, rng_text):
+        app = self.app
+        with app.app.app_context():
+            job = app.newsletter_job(
+                app.User.query.first(), "send_test_newsletters", "bench"
+            )
+            result = app.run_newsletter_jobs("send_test_newsletters", [job])[0]
+            if isinstance(result, Exception):
+                raise result
+
+    def run(self, scenario, iterations):
+        import random
+
+        rng = random.Random(scenario)
+        action = getattr(self, scenario)
+
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for i in range(iterations):
+            text = dataset.fake_entry_text(rng)
+            begin = time.perf_counter()
+            try:
+                action(i, text)
+            except Exception as e:
+                errors += 1
+                print(f"{scenario} iteration {i} failed: {e}")
+
+            latencies.append(time.perf_counter() - begin)
+
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def compare(current, baseline):
+    print(f"\ncomparison against {baseline['revision']} ({baseline['timestamp']})")
+    print(f"{'case':<55} {'p50':>10} {'p95':>10} {'throughput':>12}")
+    for case, result in current["results"].items():
+        previous = baseline["results"].get(case)
+        if previous is None:
+            continue
+
+        def delta(key):
+            if previous[key] == 0:
+                return "n/a"
+            return f"{(result[key] - previous[key]) / previous[key] * 100:+.1f}%"
+
+        print(
+            f"{case:<55} {delta('p50_ms'):>10} {delta('p95_ms'):>10} {delta('throughput'):>12}"
+        )
+
+
+def parse_counts(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=parse_counts, default=[1, 10])
+    parser.add_argument("--entries", type=parse_counts, default=[5, 25])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="ms per fake call")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None)
+    args = parser.parse_args()
+
+    app_module = dataset.load_app()
+    scenarios = [s for s in args.scenarios.split(",") if s]
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args) | {"scenarios": scenarios},
+        "results": {},
+    }
+
+    for users in args.users:
+        for entries in args.entries:
+            backends = FakeBackends(args.latency, args.jitter, args.error_rate, args.seed)
+            backends.install(app_module)
+            dataset.seed(
+                app_module, users, entries, args.seed, backends.memory_index
+            )
+
+            bench = PipelineBench(app_module, backends)
+            for scenario in scenarios:
+                case = f"{scenario}/users={users}/entries={entries}"
+                app_module.NEWSLETTER_TIMINGS.reset()
+                result = bench.run(scenario, args.iterations)
+                report["results"][case] = result | {
+                    "services": backends.stats(),
+                    "stages": app_module.NEWSLETTER_TIMINGS.snapshot(),
+                }
+
+                print(
+                    f"{case:<55} p50 {result['p50_ms']:8.1f}ms  p95 {result['p95_ms']:8.1f}ms  "
+                    f"p99 {result['p99_ms']:8.1f}ms  {result['throughput']:7.2f}/s  "
+                    f"errors {result['errors']}"
+                )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{report['revision']}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print(f"\nresults written to {output}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
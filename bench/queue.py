@@ -0,0 +1,113 @@
+# newsletter queue throughput against the number of workers draining it
+#
+#   python -m bench.queue --workers 1,2,4,8 --users 200 --latency 20
+#
+# queues the weekly newsletter of every seeded user through
+# `prepare_newsletter_batch` at their (shared) send time, then drains the
+# queue with `workers` threads, each standing in for a worker process with its
+# own session; sqlite serializes the claims, MySQL's SKIP LOCKED doesn't
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from bench import dataset
+from bench.fakes import FakeBackends
+from bench.pipeline import RESULTS_DIR, git_revision, parse_counts
+
+
+def drain(app_module, workers):
+    worked = []
+    errors = []
+
+    def worker():
+        with app_module.app.app_context():
+            try:
+                worked.append(app_module.drain_newsletter_queue())
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return worked, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=parse_counts, default=[1, 2, 4, 8])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=5)
+    parser.add_argument("--claim-size", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=20.0, help="ms per fake call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    app_module = dataset.load_app()
+    if args.claim_size is not None:
+        app_module.NEWSLETTER_CLAIM_SIZE = args.claim_size
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "results": {},
+    }
+
+    baseline = None
+    for workers in args.workers:
+        backends = FakeBackends(args.latency, seed=args.seed)
+        backends.install(app_module)
+        dataset.seed(
+            app_module, args.users, args.entries, args.seed, backends.memory_index
+        )
+
+        with app_module.app.app_context():
+            now = app_module.scheduled_send_time(
+                app_module.User.query.first(), app_module.utc_now()
+            )
+            app_module.prepare_newsletter_batch(now, limit=None)
+
+        worked, errors, elapsed = drain(app_module, workers)
+        with app_module.app.app_context():
+            prepared = app_module.Newsletter.query.filter(
+                app_module.Newsletter.sent_at.is_(None)
+            ).count()
+
+        throughput = sum(worked) / elapsed
+        baseline = baseline or throughput / workers
+
+        report["results"][f"workers={workers}"] = result = {
+            "tasks": sum(worked),
+            "per_worker": worked,
+            "errors": errors,
+            "prepared": prepared,
+            "throughput": throughput,
+            "scaling": throughput / (baseline * workers),
+        }
+
+        print(
+            f"workers={workers:<3} {result['tasks']:>5} tasks  {elapsed:7.2f}s  "
+            f"{throughput:8.2f}/s  scaling {result['scaling']:.2f}  "
+            f"prepared {result['prepared']}  errors {len(errors)}"
+        )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"queue-{report['revision']}-{int(time.time())}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# cold-start budget for a worker: import time, `create_app` time and the
+# latency of the first request, each measured in a fresh interpreter
+#
+#   python -m bench.startup --runs 5
+#
+# exits non-zero when a median goes over its budget
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from bench import dataset
+
+# milliseconds
+BUDGETS = {
+    "import": 1000.0,
+    "create_app": 150.0,
+    "first_request": 150.0,
+}
+
+# runs inside the child interpreter, with no service credentials in the environment
+PROBE = """
+import json, os, sys, time
+
+sys.path.insert(0, os.environ["RITUAL_ROOT"])
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app(start_scheduler=False)
+created = time.perf_counter()
+
+with app.app.app_context():
+    app.db.create_all()
+
+client = app.app.test_client()
+request_started = time.perf_counter()
+response = client.get("/user-lookup", query_string={"username": "nobody@example.com"})
+finished = time.perf_counter()
+assert response.status_code == 200, response.status_code
+
+print(json.dumps({
+    "import": (imported - started) * 1000,
+    "create_app": (created - imported) * 1000,
+    "first_request": (finished - request_started) * 1000,
+}))
+"""
+
+CREDENTIAL_VARIABLES = (
+    "OPENAI_API_KEY",
+    "PINECONE_API_KEY",
+    "EXAI_API_KEY",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "RITUAL_EMAIL_API_KEY",
+)
+
+
+def probe(db_path):
+    env = {k: v for k, v in os.environ.items() if k not in CREDENTIAL_VARIABLES}
+    env |= {"RITUAL_ROOT": dataset.ROOT, "RITUAL_DB_URL": f"sqlite:///{db_path}"}
+
+    output = subprocess.check_output([sys.executable, "-c", PROBE], env=env, cwd="/")
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = {name: [] for name in BUDGETS}
+    for i in range(args.runs):
+        db_path = os.path.join(tempfile.mkdtemp(prefix="ritual-startup-"), "startup.db")
+        for name, value in probe(db_path).items():
+            samples[name].append(value)
+
+    over = []
+    for name, budget in BUDGETS.items():
+        median = statistics.median(samples[name])
+        status = "ok" if median <= budget else "OVER BUDGET"
+        print(
+            f"{name:<14} median {median:8.1f}ms  max {max(samples[name]):8.1f}ms  "
+            f"budget {budget:8.1f}ms  {status}"
+        )
+
+        if median > budget:
+            over.append(name)
+
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
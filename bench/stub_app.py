@@ -0,0 +1,83 @@
+# gunicorn entry point serving `app` against the fake backends
+#
+#   RITUAL_BENCH_DB=/tmp/bench.db gunicorn -w 4 bench.stub_app:app
+#
+# the database must already be seeded (`bench.loadtest` does this)
+# every response carries the worker pid, the number of requests that worker
+# had in flight and the time spent inside the app, so the load generator can
+# separate queueing from service time
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import g, request
+from sqlalchemy import event
+
+from bench import dataset
+from bench.fakes import FakeBackends
+
+app_module = dataset.load_app(os.environ["RITUAL_BENCH_DB"])
+
+backends = FakeBackends(
+    latency_ms=float(os.environ.get("RITUAL_BENCH_LATENCY_MS", 0)),
+    jitter=float(os.environ.get("RITUAL_BENCH_JITTER", 0.2)),
+    error_rate=float(os.environ.get("RITUAL_BENCH_ERROR_RATE", 0)),
+    seed=int(os.environ.get("RITUAL_BENCH_SEED", 0)) + os.getpid(),
+)
+backends.install(app_module)
+
+app = app_module.app
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+with app.app_context():
+
+    @event.listens_for(app_module.db.engine, "connect")
+    def _sqlite_pragmas(connection, _):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=30000")
+        cursor.close()
+
+
+@app.before_request
+def _bench_before():
+    global _in_flight
+
+    with _in_flight_lock:
+        _in_flight += 1
+        g.bench_in_flight = _in_flight
+
+    g.bench_started = time.perf_counter()
+
+    # keep the weekly throttle from turning every generation into a 429
+    if request.endpoint == "web_newsletter":
+        auth = request.headers.get("Authorization", "")
+        token = app_module.Token.query.filter_by(data=auth.split(" ")[-1]).first()
+        if token is not None:
+            app_module.User.query.filter_by(user_id=token.user_id).update(
+                {app_module.User.last_newsletter: datetime(2000, 1, 1)}
+            )
+            app_module.db.session.commit()
+
+
+@app.after_request
+def _bench_after(response):
+    response.headers["X-Bench-Worker"] = str(os.getpid())
+    response.headers["X-Bench-In-Flight"] = str(g.get("bench_in_flight", 0))
+    response.headers["X-Bench-Service-Ms"] = (
+        f"{(time.perf_counter() - g.get('bench_started', time.perf_counter())) * 1000:.3f}"
+    )
+
+    return response
+
+
+@app.teardown_request
+def _bench_teardown(_):
+    global _in_flight
+
+    with _in_flight_lock:
+        _in_flight -= 1
@@ -0,0 +1,73 @@
+# content-addressed file store for large binary payloads
+#
+# blobs are named by the sha256 of their bytes, so storing the same payload
+# twice is free and a name always refers to the same content
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def is_digest(value):
+    return isinstance(value, str) and DIGEST.fullmatch(value) is not None
+
+
+class BlobStore:
+    def __init__(self, path):
+        self.path = path
+
+    # anything but a sha256 hex digest is refused, a name like "../x" or
+    # "/etc/passwd" would otherwise resolve outside the store
+    def _path(self, digest):
+        if not is_digest(digest):
+            raise ValueError(f"not a blob digest: {digest!r}")
+
+        return os.path.join(self.path, digest[:2], digest)
+
+    # returns the digest the blob can be read back with
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            # a fresh mtime tells `delete` it's in use again
+            os.utime(path)
+            return digest
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # written next to its final name and renamed, readers never see a partial blob
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+    def exists(self, digest):
+        return is_digest(digest) and os.path.exists(self._path(digest))
+
+    # only when the blob hasn't been written or stored again in the last
+    # `grace` seconds; returns whether it was deleted
+    def delete(self, digest, grace=0):
+        path = self._path(digest)
+        try:
+            if os.path.getmtime(path) > time.time() - grace:
+                return False
+
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+
+        return True
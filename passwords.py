@@ -0,0 +1,99 @@
+# bcrypt hashing on a bounded pool of worker processes
+#
+# a bcrypt check is 100ms+ of pure CPU at the default cost; run on request
+# threads, a burst of logins takes every core the API has. the pool caps how
+# many cores hashing may use, and `max_pending` caps how many requests may
+# wait on it, so a burst is shed quickly instead of queueing for minutes
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+# the cost a hash was made with, from "$2b$<rounds>$<salt + hash>"
+def hash_rounds(hashed):
+    return int(hashed.split(b"$")[2])
+
+
+class PasswordHasher:
+    # `workers` 0 hashes on the calling thread
+    # `wait` is how long a caller may wait for a slot before `PoolBusy`
+    def __init__(self, rounds=12, workers=1, max_pending=None, wait=5.0):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending or max(1, workers) * 8
+        self.wait = wait
+
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # workers are spawned rather than forked, forking a process with running
+    # threads (scheduler, client pools) can copy held locks into the child
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+
+            return self._executor
+
+    def _run(self, func, *args):
+        if self.workers == 0:
+            return func(*args)
+
+        if not self._slots.acquire(timeout=self.wait):
+            raise PoolBusy("password hashing pool is busy")
+
+        try:
+            try:
+                return self._pool().submit(func, *args).result()
+            except BrokenProcessPool:
+                # a worker died (e.g. OOM killed), start over with a fresh pool
+                self._reset()
+                return self._pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _reset(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        return self._run(_hash, password.encode("utf-8"), self.rounds).decode("utf-8")
+
+    # (whether `password` matches `hashed`, a new hash when `hashed` was made
+    # with a different cost than the current one, else None)
+    def verify(self, password, hashed):
+        password = password.encode("utf-8")
+        hashed = hashed.encode("utf-8")
+
+        if not self._run(_check, password, hashed):
+            return False, None
+
+        if hash_rounds(hashed) == self.rounds:
+            return True, None
+
+        return True, self._run(_hash, password, self.rounds).decode("utf-8")
+
+    def shutdown(self):
+        self._reset()
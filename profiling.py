@@ -0,0 +1,105 @@
+# opt-in profiles of single runs, written where flamegraph tools can read them
+#
+# "sample" mode walks the profiled thread's stack every `interval` seconds
+# from a helper thread and writes folded stacks (one "root;...;leaf count"
+# line per distinct stack, for flamegraph.pl, speedscope or inferno); the
+# profiled code itself runs untouched. "cprofile" mode traces every call and
+# writes a pstats file instead, exact counts at a much higher overhead
+import cProfile
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+MODES = ("sample", "cprofile")
+
+
+class Sampler:
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if len(stack) > 0:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+# the random suffix keeps runs of the same name within a second apart, e.g.
+# two threads of one worker profiling the same endpoint
+def _path(directory, name, extension):
+    os.makedirs(directory, exist_ok=True)
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+
+    return os.path.join(
+        directory,
+        f"{stamp}-{os.getpid()}-{secrets.token_hex(4)}-{safe}.{extension}",
+    )
+
+
+# profiles the calling thread for the duration of the block, the path written
+# to is printed once it's done
+@contextmanager
+def profile(name, directory, mode="sample", interval=0.005):
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = _path(directory, name, "prof")
+            profiler.dump_stats(path)
+            print(f"profile of {name} written to {path}")
+
+        return
+
+    sampler = Sampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        path = _path(directory, name, "folded")
+        with open(path, "w") as f:
+            f.write(sampler.folded())
+        print(f"profile of {name} written to {path}")
+
+
+# for request hooks, where the start and end of the run are separate calls
+def start(name, directory, mode="sample", interval=0.005):
+    context = profile(name, directory, mode, interval)
+    context.__enter__()
+
+    return context
+
+
+def stop(context):
+    context.__exit__(None, None, None)
@@ -0,0 +1,123 @@
+# token bucket rate limiting with pluggable storage
+#
+# a bucket holds up to `capacity` tokens and refills continuously at
+# capacity / period per second; each request takes one token and is rejected
+# when the bucket is empty. `MemoryBackend` keeps buckets in the process,
+# `SqlBackend` keeps them in a table so every worker shares the same limits
+import hashlib
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+
+
+class RateLimit:
+    def __init__(self, name, capacity, period):
+        self.name = name
+        self.capacity = capacity
+        self.period = period
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+    # identifiers (ips, emails) are hashed so the store never holds them
+    def bucket_key(self, identifier):
+        digest = hashlib.sha256(str(identifier).encode("utf-8")).hexdigest()[:40]
+
+        return f"{self.name}:{digest}"
+
+    # (tokens left after taking `cost`, seconds until that's possible)
+    # tokens are only deducted when the wait is 0
+    def take(self, tokens, updated, now, cost=1.0):
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= cost:
+            return tokens - cost, 0.0
+
+        return tokens, (cost - tokens) / self.rate
+
+
+class MemoryBackend:
+    def __init__(self, max_buckets=100_000):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    # returns how many seconds to wait, 0 when the request may go ahead
+    def take(self, limit, identifier, cost=1.0):
+        key = limit.bucket_key(identifier)
+        now = time.time()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit.capacity, now))
+            tokens, wait = limit.take(tokens, updated, now, cost)
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+
+        return wait
+
+    # buckets idle for a day are as good as full, dropping them changes nothing
+    # for any limit with a period under a day
+    def _prune(self, now, idle=86400):
+        self._buckets = {
+            key: bucket
+            for key, bucket in self._buckets.items()
+            if now - bucket[1] < idle
+        }
+
+
+# `table` needs columns bucket_key (primary key), tokens and updated (floats)
+class SqlBackend:
+    def __init__(self, get_engine, table):
+        self.get_engine = get_engine
+        self.table = table
+
+    def take(self, limit, identifier, cost=1.0):
+        key = limit.bucket_key(identifier)
+        now = time.time()
+        table = self.table
+
+        # a transaction of its own, independent of the caller's session
+        with self.get_engine().begin() as connection:
+            row = self._locked_row(connection, key)
+            if row is None:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(
+                            table.insert().values(
+                                bucket_key=key, tokens=limit.capacity, updated=now
+                            )
+                        )
+                except IntegrityError:
+                    # another worker created it first
+                    pass
+
+                row = self._locked_row(connection, key)
+
+            tokens, wait = limit.take(row.tokens, row.updated, now, cost)
+            connection.execute(
+                table.update()
+                .where(table.c.bucket_key == key)
+                .values(tokens=tokens, updated=now)
+            )
+
+        return wait
+
+    def _locked_row(self, connection, key):
+        return connection.execute(
+            sa.select(self.table.c.tokens, self.table.c.updated)
+            .where(self.table.c.bucket_key == key)
+            .with_for_update()
+        ).first()
+
+    # see `MemoryBackend._prune`
+    def prune(self, idle=86400):
+        with self.get_engine().begin() as connection:
+            result = connection.execute(
+                self.table.delete().where(self.table.c.updated < time.time() - idle)
+            )
+
+        return result.rowcount
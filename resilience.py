@@ -0,0 +1,206 @@
+# timeouts, retries and circuit breakers for calls to external services
+#
+# a `deadline` bounds the total time a unit of work (one user's newsletter,
+# one request) may spend across all of its calls and retries; breakers make
+# calls to a service that keeps failing return immediately instead of
+# waiting out a timeout every time
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # whether a call may go through right now
+    # once the cooldown passes a single probe call is let through
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    # the service answered, just not with something worth retrying
+    def record_neutral(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self.failures = 0
+
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open(self.reset_timeout)
+
+    # opens the breaker right away, e.g. when a quota is exhausted
+    def trip(self, duration=None):
+        with self._lock:
+            self._open(self.reset_timeout if duration is None else duration)
+
+    def _open(self, duration):
+        if self.state != self.OPEN:
+            print(f"circuit '{self.name}' opened for {duration:.0f}s")
+
+        self.state = self.OPEN
+        # a long trip (e.g. quota) isn't shortened by later ordinary failures
+        self.opened_until = max(self.opened_until, time.monotonic() + duration)
+        self._probing = False
+
+
+class RetryPolicy:
+    def __init__(self, attempts=3, timeout=30.0, base_delay=0.25, max_delay=4.0):
+        self.attempts = attempts
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    # "full jitter" exponential backoff
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+_deadline = ContextVar("deadline", default=None)
+
+
+# bounds everything inside the block to `seconds`, nested deadlines can only shrink
+@contextmanager
+def deadline(seconds):
+    until = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        until = min(until, current)
+
+    reset_token = _deadline.set(until)
+    try:
+        yield
+    finally:
+        _deadline.reset(reset_token)
+
+
+# seconds left before the current deadline, None if there isn't one
+def remaining():
+    until = _deadline.get()
+    if until is None:
+        return None
+
+    return until - time.monotonic()
+
+
+# per-call timeout: the policy's timeout, cut short by the deadline
+def call_timeout(policy):
+    left = remaining()
+    if left is None:
+        return policy.timeout
+
+    if left <= 0:
+        raise DeadlineExceeded("deadline exceeded")
+
+    return min(policy.timeout, left)
+
+
+def _before_attempt(breaker, policy):
+    if not breaker.allow():
+        raise CircuitOpenError(f"circuit '{breaker.name}' is open")
+
+    return call_timeout(policy)
+
+
+def _retry_delay(policy, attempt, error):
+    if attempt + 1 >= policy.attempts:
+        raise error
+
+    delay = policy.backoff(attempt)
+    left = remaining()
+    if left is not None and delay >= left:
+        raise error
+
+    return delay
+
+
+# calls `func(timeout)` under `breaker` and `policy`, where `timeout` is the
+# number of seconds this attempt may take
+# only errors for which `is_transient(error)` is true are retried or count
+# against the breaker; anything else is raised straight away
+def call(breaker, policy, is_transient, func):
+    attempt = 0
+    while True:
+        timeout = _before_attempt(breaker, policy)
+
+        try:
+            result = func(timeout)
+        except Exception as e:
+            if not is_transient(e):
+                breaker.record_neutral()
+                raise
+
+            breaker.record_failure()
+            time.sleep(_retry_delay(policy, attempt, e))
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        return result
+
+
+# `func(timeout)` returns an awaitable, which is also cancelled at `timeout`
+async def call_async(breaker, policy, is_transient, func):
+    attempt = 0
+    while True:
+        timeout = _before_attempt(breaker, policy)
+
+        try:
+            result = await asyncio.wait_for(func(timeout), timeout=timeout)
+        except Exception as e:
+            if not (isinstance(e, asyncio.TimeoutError) or is_transient(e)):
+                breaker.record_neutral()
+                raise
+
+            breaker.record_failure()
+            await asyncio.sleep(_retry_delay(policy, attempt, e))
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        return result
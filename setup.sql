@@ -101,6 +101,170 @@ CREATE TABLE if not exists `user` (
   UNIQUE KEY `unique_username` (`username`)
 ) ENGINE=InnoDB AUTO_INCREMENT=3 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `llm_usage`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `llm_usage` (
+  `usage_id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `route` varchar(64) NOT NULL,
+  `model` varchar(64) NOT NULL,
+  `week` date NOT NULL,
+  `requests` int NOT NULL DEFAULT 0,
+  `prompt_tokens` int NOT NULL DEFAULT 0,
+  `completion_tokens` int NOT NULL DEFAULT 0,
+  PRIMARY KEY (`usage_id`),
+  UNIQUE KEY `uc_llm_usage` (`user_id`,`route`,`model`,`week`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `email_embedding`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `email_embedding` (
+  `email_id` int NOT NULL,
+  `user_id` int NOT NULL,
+  `vector` blob NOT NULL,
+  PRIMARY KEY (`email_id`),
+  KEY `ix_email_embedding_user_id` (`user_id`),
+  CONSTRAINT `email_embedding_ibfk_1` FOREIGN KEY (`email_id`) REFERENCES `email` (`email_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `email_blob`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `email_blob` (
+  `email_id` int NOT NULL,
+  `digest` varchar(64) NOT NULL,
+  PRIMARY KEY (`email_id`,`digest`),
+  KEY `ix_email_blob_digest` (`digest`),
+  CONSTRAINT `email_blob_ibfk_1` FOREIGN KEY (`email_id`) REFERENCES `email` (`email_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `orphan_blob`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `orphan_blob` (
+  `digest` varchar(64) NOT NULL,
+  `released_at` datetime NOT NULL,
+  PRIMARY KEY (`digest`),
+  KEY `ix_orphan_blob_released_at` (`released_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `emotion_week`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `emotion_week` (
+  `emotion_week_id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `week` date NOT NULL,
+  `entries` int NOT NULL DEFAULT 0,
+  `scores` json NOT NULL,
+  PRIMARY KEY (`emotion_week_id`),
+  UNIQUE KEY `uc_emotion_week` (`user_id`,`week`),
+  CONSTRAINT `emotion_week_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`user_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `newsletter`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `newsletter` (
+  `newsletter_id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `creation_date` datetime NOT NULL,
+  `subject` varchar(256) DEFAULT NULL,
+  `html` mediumtext NOT NULL,
+  `color` varchar(16) DEFAULT NULL,
+  `scheduled_for` datetime DEFAULT NULL,
+  `sent_at` datetime DEFAULT NULL,
+  PRIMARY KEY (`newsletter_id`),
+  KEY `ix_newsletter_user_id` (`user_id`),
+  KEY `ix_newsletter_scheduled_for` (`scheduled_for`),
+  CONSTRAINT `newsletter_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`user_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `rate_limit_bucket`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `rate_limit_bucket` (
+  `bucket_key` varchar(128) NOT NULL,
+  `tokens` double NOT NULL,
+  `updated` double NOT NULL,
+  PRIMARY KEY (`bucket_key`),
+  KEY `ix_rate_limit_bucket_updated` (`updated`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `newsletter_request`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `newsletter_request` (
+  `request_id` varchar(32) NOT NULL,
+  `user_id` int NOT NULL,
+  `creation_date` datetime NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `started_at` datetime DEFAULT NULL,
+  `entries` json NOT NULL,
+  `newsletter_id` int DEFAULT NULL,
+  `html_tree` json DEFAULT NULL,
+  PRIMARY KEY (`request_id`),
+  KEY `ix_newsletter_request_user_id` (`user_id`),
+  KEY `ix_newsletter_request_status` (`status`),
+  KEY `newsletter_id` (`newsletter_id`),
+  CONSTRAINT `newsletter_request_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`user_id`) ON DELETE CASCADE,
+  CONSTRAINT `newsletter_request_ibfk_2` FOREIGN KEY (`newsletter_id`) REFERENCES `newsletter` (`newsletter_id`) ON DELETE SET NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+--
+-- Table structure for table `newsletter_task`
+--
+
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE if not exists `newsletter_task` (
+  `task_id` int NOT NULL AUTO_INCREMENT,
+  `route` varchar(64) NOT NULL,
+  `user_id` int NOT NULL,
+  `creation_date` datetime NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `attempts` int NOT NULL,
+  `available_at` datetime NOT NULL,
+  `leased_until` datetime DEFAULT NULL,
+  `claim` varchar(32) DEFAULT NULL,
+  `last_error` text,
+  `scheduled_for` datetime DEFAULT NULL,
+  PRIMARY KEY (`task_id`),
+  UNIQUE KEY `ix_newsletter_task_send` (`route`,`user_id`,`scheduled_for`),
+  KEY `ix_newsletter_task_user_id` (`user_id`),
+  KEY `ix_newsletter_task_claim` (`claim`),
+  KEY `ix_newsletter_task_claimable` (`status`,`available_at`),
+  CONSTRAINT `newsletter_task_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`user_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
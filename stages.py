@@ -0,0 +1,147 @@
+# staged pipelines on asyncio, with an executor and concurrency limit per stage
+#
+# every item runs through the steps of a pipeline in order, a step being one
+# stage or a tuple of stages that run together. a stage is a coroutine
+# function, a plain function run on the event loop thread (`INLINE`), or a
+# plain function run on an executor. each stage only lets `concurrency` items
+# in at once and records how long it takes, so a slow or saturated stage
+# shows up on its own instead of as a slow pipeline
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from contextlib import nullcontext
+
+# runs a plain function on the event loop thread, for quick work or work tied
+# to that thread (e.g. a database session)
+INLINE = "inline"
+
+
+class Stage:
+    # `executor` is None for coroutine functions, `INLINE`, or a function
+    # returning the `concurrent.futures.Executor` to run `func` on
+    # `concurrency` None means unbounded
+    def __init__(self, name, func, executor=None, concurrency=None):
+        self.name = name
+        self.func = func
+        self.executor = executor
+        self.concurrency = concurrency
+
+
+class StageTimings:
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, pipeline, stage, seconds, failed):
+        with self._lock:
+            stats = self._stats.setdefault(
+                (pipeline, stage),
+                {"runs": 0, "failures": 0, "total": 0.0, "max": 0.0},
+            )
+            stats["runs"] += 1
+            stats["failures"] += int(failed)
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+
+    # {pipeline: {stage: stats}}, times in milliseconds
+    def snapshot(self):
+        with self._lock:
+            stats = list(self._stats.items())
+
+        result = {}
+        for (pipeline, stage), s in stats:
+            result.setdefault(pipeline, {})[stage] = {
+                "runs": s["runs"],
+                "failures": s["failures"],
+                "total_ms": round(s["total"] * 1000, 3),
+                "mean_ms": round(s["total"] * 1000 / s["runs"], 3),
+                "max_ms": round(s["max"] * 1000, 3),
+            }
+
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    # one line per stage of `pipeline`, in the order they first ran
+    def summary(self, pipeline):
+        stages = self.snapshot().get(pipeline, {})
+
+        return "\n".join(
+            f"  {stage:<10} runs {s['runs']:>5}  failed {s['failures']:>4}  "
+            f"mean {s['mean_ms']:9.1f}ms  max {s['max_ms']:9.1f}ms"
+            for stage, s in stages.items()
+        )
+
+
+class Pipeline:
+    # `scope(item)` returns a context manager wrapped around the item's whole run
+    def __init__(self, name, steps, timings, scope=None):
+        self.name = name
+        self.steps = [step if isinstance(step, tuple) else (step,) for step in steps]
+        self.timings = timings
+        self.scope = scope or (lambda item: nullcontext())
+
+    @property
+    def stages(self):
+        return [stage for step in self.steps for stage in step]
+
+    async def _run_stage(self, stage, item, semaphores):
+        async with semaphores[stage.name]:
+            started = time.perf_counter()
+            failed = True
+            try:
+                if stage.executor is None:
+                    await stage.func(item)
+                elif stage.executor == INLINE:
+                    stage.func(item)
+                else:
+                    # the copy carries context variables (scopes, deadlines) over
+                    context = contextvars.copy_context()
+                    await asyncio.get_running_loop().run_in_executor(
+                        stage.executor(), functools.partial(context.run, stage.func, item)
+                    )
+
+                failed = False
+            finally:
+                self.timings.record(
+                    self.name, stage.name, time.perf_counter() - started, failed
+                )
+
+    async def _run_item(self, item, semaphores):
+        with self.scope(item):
+            for step in self.steps:
+                if len(step) == 1:
+                    await self._run_stage(step[0], item, semaphores)
+                else:
+                    await asyncio.gather(
+                        *(self._run_stage(stage, item, semaphores) for stage in step)
+                    )
+
+        return item
+
+    # returns each item, or the exception that stopped it, in order
+    # `concurrency` bounds the items in flight across all stages
+    async def run(self, items, concurrency=None):
+        # semaphores belong to the loop they're used on, so one set per run
+        semaphores = {
+            stage.name: asyncio.Semaphore(stage.concurrency)
+            if stage.concurrency is not None
+            else nullcontext()
+            for stage in self.stages
+        }
+
+        in_flight = (
+            asyncio.Semaphore(concurrency) if concurrency is not None else nullcontext()
+        )
+
+        async def run_item(item):
+            async with in_flight:
+                return await self._run_item(item, semaphores)
+
+        return await asyncio.gather(
+            *(run_item(item) for item in items), return_exceptions=True
+        )
@@ -0,0 +1,155 @@
+# persistent key/value cache with per-namespace TTLs and size bounds
+#
+# backed by a local sqlite file so it survives restarts and is shared by every
+# worker process on the host; values are stored as JSON. every call is a
+# blocking sqlite round trip, async callers run them off the event loop
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS cache_namespace_accessed ON cache (namespace, accessed);
+"""
+
+# sqlite caps the parameters of one statement at 999 on older builds
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+# one connection per (thread, path), sqlite connections can't be shared across threads
+def _connection(path):
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    connection = connections.get(path)
+    if connection is None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        connections[path] = connection
+
+    return connection
+
+
+class TTLCache:
+    # a hit only refreshes the entry's access time once it's `touch_after`
+    # seconds old, so reads mostly don't write; eviction order is that coarse
+    def __init__(
+        self, path, namespace, ttl, max_entries, evict_every=100, touch_after=300
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.touch_after = touch_after
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    # returns None when the key is missing or expired
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    # returns {key: value} for every key that is cached and fresh, in one read
+    # per `BATCH_SIZE` keys and at most one write per batch for access times
+    def get_many(self, keys):
+        connection = _connection(self.path)
+        now = time.time()
+        keys = list(dict.fromkeys(keys))
+
+        found = {}
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i : i + BATCH_SIZE]
+            rows = connection.execute(
+                "SELECT key, value, expires, accessed FROM cache "
+                f"WHERE namespace = ? AND key IN ({', '.join('?' * len(batch))})",
+                (self.namespace, *batch),
+            ).fetchall()
+
+            stale = []
+            for key, value, expires, accessed in rows:
+                if expires <= now:
+                    continue
+
+                found[key] = json.loads(value)
+                if accessed <= now - self.touch_after:
+                    stale.append(key)
+
+            if len(stale) > 0:
+                connection.execute(
+                    "UPDATE cache SET accessed = ? "
+                    f"WHERE namespace = ? AND key IN ({', '.join('?' * len(stale))})",
+                    (now, self.namespace, *stale),
+                )
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return {key: found[key] for key in keys if key in found}
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    # writes every item of `items` ({key: value}) in one transaction
+    def set_many(self, items):
+        if len(items) == 0:
+            return
+
+        connection = _connection(self.path)
+        now = time.time()
+
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.namespace, key, json.dumps(value), now + self.ttl, now)
+                    for key, value in items.items()
+                ],
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            before = self._writes
+            self._writes += len(items)
+            evict = self._writes // self.evict_every > before // self.evict_every
+
+        if evict:
+            self.evict()
+
+    # drops expired entries, then the least recently used ones over `max_entries`
+    def evict(self):
+        connection = _connection(self.path)
+
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND expires <= ?",
+            (self.namespace, time.time()),
+        )
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache WHERE namespace = ? "
+            "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries),
+        )
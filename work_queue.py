@@ -0,0 +1,137 @@
+# database-backed task queue shared by any number of worker processes
+#
+# a worker claims a few tasks at a time by leasing them: the rows are locked
+# with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent claims pass over each
+# other instead of queueing, then stamped with a claim token and a lease
+# expiry. a worker that dies loses its lease and the tasks are claimed again;
+# a task that fails is retried with backoff until it runs out of attempts
+import secrets
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+# `table` needs columns task_id (primary key), status, attempts, available_at,
+# leased_until, claim and last_error, plus whatever the tasks carry
+class WorkQueue:
+    def __init__(self, get_engine, table, lease, max_attempts=3, retry_delay=60.0):
+        self.get_engine = get_engine
+        self.table = table
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def _claimable(self, now):
+        table = self.table
+
+        return sa.or_(
+            sa.and_(table.c.status == PENDING, table.c.available_at <= now),
+            sa.and_(table.c.status == LEASED, table.c.leased_until < now),
+        )
+
+    # leases up to `limit` tasks, in a transaction of its own so other workers
+    # see the lease right away; `where` narrows the tasks that may be claimed
+    # returns the claimed rows
+    def claim(self, limit, *where):
+        table = self.table
+        now = datetime.now()
+        claim = secrets.token_hex(16)
+
+        with self.get_engine().begin() as connection:
+            # leases that ran out on their last attempt
+            connection.execute(
+                table.update()
+                .where(
+                    table.c.status == LEASED,
+                    table.c.leased_until < now,
+                    table.c.attempts >= self.max_attempts,
+                )
+                .values(status=FAILED, last_error="lease expired")
+            )
+
+            task_ids = [
+                task_id
+                for (task_id,) in connection.execute(
+                    sa.select(table.c.task_id)
+                    .where(self._claimable(now), *where)
+                    .order_by(table.c.task_id)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                )
+            ]
+            if len(task_ids) == 0:
+                return []
+
+            # the condition is checked again, databases without SKIP LOCKED
+            # (sqlite) may have let another worker read the same rows
+            connection.execute(
+                table.update()
+                .where(table.c.task_id.in_(task_ids), self._claimable(now))
+                .values(
+                    status=LEASED,
+                    claim=claim,
+                    attempts=table.c.attempts + 1,
+                    leased_until=now + timedelta(seconds=self.lease),
+                )
+            )
+
+            return connection.execute(
+                sa.select(table).where(table.c.claim == claim).order_by(table.c.task_id)
+            ).all()
+
+    # `connection` is anything with `execute`, e.g. the session that commits
+    # the task's results, so the results and the completion land together
+    # tasks whose lease ran out and were claimed again are left to their new owner
+    def complete(self, connection, tasks):
+        if len(tasks) == 0:
+            return
+
+        table = self.table
+        connection.execute(
+            table.update()
+            .where(
+                table.c.task_id.in_([t.task_id for t in tasks]),
+                table.c.claim.in_({t.claim for t in tasks}),
+            )
+            .values(status=DONE, leased_until=None, last_error=None)
+        )
+
+    # retried after an exponential backoff while attempts remain
+    def fail(self, connection, task, error):
+        table = self.table
+        statement = table.update().where(
+            table.c.task_id == task.task_id, table.c.claim == task.claim
+        )
+
+        if task.attempts >= self.max_attempts:
+            connection.execute(
+                statement.values(status=FAILED, leased_until=None, last_error=error)
+            )
+            return
+
+        delay = self.retry_delay * 2 ** (task.attempts - 1)
+        connection.execute(
+            statement.values(
+                status=PENDING,
+                leased_until=None,
+                available_at=datetime.now() + timedelta(seconds=delay),
+                last_error=error,
+            )
+        )
+
+    # {status: count}
+    def counts(self, connection, *where):
+        table = self.table
+
+        return dict(
+            connection.execute(
+                sa.select(table.c.status, sa.func.count())
+                .where(*where)
+                .group_by(table.c.status)
+            ).all()
+        )